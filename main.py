@@ -21,14 +21,32 @@ from telegram.ext import (
     CallbackQueryHandler,
     ChatMemberHandler,
     ConversationHandler,
+    BaseUpdateProcessor,
+    BaseRateLimiter,
 )
 from telegram.constants import ParseMode
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest, Forbidden, RetryAfter
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import psycopg2.extras
 from PIL import Image, ImageDraw, ImageFont
 import arabic_reshaper
 from bidi.algorithm import get_display
 import time
 import asyncio
+import threading
+import weakref
+import contextvars
+import pickle
+import hashlib
+import heapq
+import multiprocessing
+from collections import OrderedDict, deque
+from array import array
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # --- پیکربندی اصلی ---
 OWNER_IDS = [7662192190, 6041119040] # آیدی‌های عددی ادمین‌های اصلی ربات
@@ -880,7 +898,6 @@ GAME_DESCRIPTIONS = {
 
 SAMEGAME_WIDTH, SAMEGAME_HEIGHT = 10, 10
 SAMEGAME_COLORS = ["🟥", "🟩", "🟦", "🟨", "🟪"]
-EMPTY_CELL = "⬛️" # یا هر اموجی دیگری که برای خانه خالی می‌پسندید
 
 # (این را کنار بقیه لیست‌ها مثل WORD_LIST قرار دهید)
 NUMBER_EMOJIS = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟", "1️⃣1️⃣", "1️⃣2️⃣", "1️⃣3️⃣"]
@@ -889,14 +906,217 @@ NUMBER_EMOJIS = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- مدیریت دیتابیس (بدون تغییر) ---
+# --- مدیریت دیتابیس (Connection Pool) ---
 DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_MIN_CONN = int(os.environ.get("DB_POOL_MIN_CONN", "1")) # تعداد اتصال‌هایی که همیشه باز نگه داشته می‌شوند
+DB_POOL_MAX_CONN = int(os.environ.get("DB_POOL_MAX_CONN", "10")) # حداکثر اتصال همزمان به دیتابیس
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5")) # حداکثر زمان انتظار برای گرفتن اتصال از Pool (ثانیه)
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_HEALTHCHECK_INTERVAL", "30")) # اتصال‌هایی که بیشتر از این مدت بیکار بوده‌اند قبل از استفاده تست می‌شوند
+
+class DatabasePool:
+    """
+    یک Pool اتصال thread-safe روی ThreadedConnectionPool.
+    گرفتن اتصال حداکثر DB_POOL_TIMEOUT ثانیه منتظر می‌ماند و اتصال‌های بیکار قبل از تحویل با SELECT 1 تست می‌شوند.
+    """
+
+    def __init__(self, dsn, min_conn, max_conn, timeout, healthcheck_interval):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_conn, max_conn, dsn)
+        self._slots = threading.BoundedSemaphore(max_conn)
+        self._max_conn = max_conn
+        self._timeout = timeout
+        self._healthcheck_interval = healthcheck_interval
+        self._last_used = {}
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise psycopg2.pool.PoolError(f"timed out after {self._timeout}s waiting for a free connection")
+        try:
+            # اتصال‌های خراب را دور می‌اندازیم تا یک اتصال سالم پیدا شود؛ بیش از max_conn اتصال بیکار
+            # در Pool نیست، پس بعد از این تعداد دور انداختن، اتصال بعدی حتماً تازه باز شده است
+            for _ in range(self._max_conn):
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+            self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+        self._last_used.clear()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self._healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+db_pool = None
+DB_POOL_RETRY_INTERVAL = float(os.environ.get("DB_POOL_RETRY_INTERVAL", "5")) # فاصله تلاش مجدد برای ساخت Pool وقتی دیتابیس در دسترس نیست (ثانیه)
+_db_pool_lock = threading.Lock()
+_db_pool_last_attempt = float('-inf')
+_db_pool_closed = False
+
+def _create_db_pool():
+    """Pool را می‌سازد؛ فراخوان باید _db_pool_lock را در دست داشته باشد."""
+    global db_pool, _db_pool_last_attempt
+    _db_pool_last_attempt = time.monotonic()
+    try:
+        db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+        logger.info(f"Database pool created (min={DB_POOL_MIN_CONN}, max={DB_POOL_MAX_CONN}).")
+    except Exception as e:
+        logger.error(f"Database pool creation failed: {e}")
+        db_pool = None
+    return db_pool
+
+def init_db_pool():
+    """Pool دیتابیس و thread pool اجرای کوئری‌ها را یک بار در شروع برنامه می‌سازد."""
+    global db_executor
+    # هر thread حداکثر یک اتصال در دست دارد، پس تعداد thread ها برابر سقف Pool است
+    db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_CONN, thread_name_prefix="db")
+    with _db_pool_lock:
+        _create_db_pool()
+
+def get_db_pool():
+    """
+    Pool را برمی‌گرداند. اگر دیتابیس در شروع برنامه در دسترس نبود، حداکثر هر DB_POOL_RETRY_INTERVAL ثانیه
+    یک بار دوباره برای ساخت آن تلاش می‌کند و پس از موفقیت جداول را می‌سازد.
+    """
+    pool = db_pool
+    if pool is not None or _db_pool_closed:
+        return pool
+    with _db_pool_lock:
+        if db_pool is not None or time.monotonic() - _db_pool_last_attempt < DB_POOL_RETRY_INTERVAL:
+            return db_pool
+        pool = _create_db_pool()
+    if pool is not None:
+        setup_database()
+    return pool
+
+def close_db_pool():
+    global db_pool, db_executor, _db_pool_closed
+    _db_pool_closed = True
+    if db_executor:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+    if db_pool:
+        db_pool.closeall()
+        db_pool = None
+
 def get_db_connection():
-    try: return psycopg2.connect(DATABASE_URL)
+    """یک اتصال از Pool برمی‌گرداند. اتصال باید حتماً با release_db_connection آزاد شود."""
+    pool = get_db_pool()
+    if not pool:
+        logger.error("Database connection failed: pool is not available")
+        return None
+    try: return pool.getconn()
     except Exception as e:
         logger.error(f"Database connection failed: {e}")
         return None
 
+def release_db_connection(conn):
+    if conn is None or not db_pool: return
+    try: db_pool.putconn(conn)
+    except Exception as e: logger.error(f"Returning connection to pool failed: {e}")
+
+# --- دسترسی غیرهمزمان به دیتابیس ---
+# کوئری‌های psycopg2 روی یک thread pool اختصاصی اجرا می‌شوند تا event loop هرگز منتظر دیتابیس نماند.
+DB_QUERY_TIMEOUT = float(os.environ.get("DB_QUERY_TIMEOUT", "5")) # حداکثر زمان اجرای هر کوئری (ثانیه)
+db_executor = None
+
+def _run_db_transaction(func, args, timeout):
+    """func(cur, *args) را داخل یک تراکنش با statement_timeout اجرا می‌کند (روی thread های db_executor)."""
+    conn = get_db_connection()
+    if not conn:
+        raise psycopg2.OperationalError("no database connection available")
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL statement_timeout = %s;", (int(timeout * 1000),))
+            result = func(cur, *args)
+        conn.commit()
+        return result
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+async def db_run(func, *args, timeout: float = DB_QUERY_TIMEOUT):
+    """
+    func(cur, *args) را در یک تراکنش و خارج از event loop اجرا می‌کند و نتیجه آن را برمی‌گرداند.
+    خطاها به فراخوان منتقل می‌شوند؛ برای کوئری‌های ساده از db_fetchone / db_fetchall / db_execute استفاده کنید.
+    """
+    if not db_executor:
+        raise psycopg2.OperationalError("database executor is not initialized")
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(db_executor, _run_db_transaction, func, args, timeout)
+    # زمان انتظار برای گرفتن اتصال از Pool هم به سقف زمانی اضافه می‌شود
+    return await asyncio.wait_for(future, timeout + DB_POOL_TIMEOUT)
+
+def _fetchone(cur, query, params):
+    cur.execute(query, params)
+    return cur.fetchone()
+
+def _fetchall(cur, query, params):
+    cur.execute(query, params)
+    return cur.fetchall()
+
+def _execute(cur, query, params):
+    cur.execute(query, params)
+    return cur.rowcount
+
+async def db_fetchone(query: str, params=None, timeout: float = DB_QUERY_TIMEOUT):
+    """اولین ردیف نتیجه را برمی‌گرداند؛ در صورت خطا None."""
+    try: return await db_run(_fetchone, query, params, timeout=timeout)
+    except Exception as e:
+        logger.error(f"Database query failed: {e}")
+        return None
+
+async def db_fetchall(query: str, params=None, timeout: float = DB_QUERY_TIMEOUT):
+    """تمام ردیف‌های نتیجه را برمی‌گرداند؛ در صورت خطا None."""
+    try: return await db_run(_fetchall, query, params, timeout=timeout)
+    except Exception as e:
+        logger.error(f"Database query failed: {e}")
+        return None
+
+async def db_execute(query: str, params=None, timeout: float = DB_QUERY_TIMEOUT):
+    """یک دستور تغییر داده را اجرا و commit می‌کند و تعداد ردیف‌های تغییرکرده را برمی‌گرداند؛ در صورت خطا None."""
+    try: return await db_run(_execute, query, params, timeout=timeout)
+    except Exception as e:
+        logger.error(f"Database query failed: {e}")
+        return None
+
 def setup_database():
     conn = get_db_connection()
     if conn:
@@ -907,25 +1127,708 @@ def setup_database():
                 cur.execute("CREATE TABLE IF NOT EXISTS start_message (id INT PRIMARY KEY, message_id BIGINT, chat_id BIGINT);")
                 cur.execute("CREATE TABLE IF NOT EXISTS banned_users (user_id BIGINT PRIMARY KEY);")
                 cur.execute("CREATE TABLE IF NOT EXISTS banned_groups (group_id BIGINT PRIMARY KEY);")
+                cur.execute("CREATE TABLE IF NOT EXISTS typing_images (sentence TEXT PRIMARY KEY, file_id VARCHAR(255) NOT NULL);")
+                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable BOOLEAN NOT NULL DEFAULT FALSE;")
+                cur.execute("ALTER TABLE groups ADD COLUMN IF NOT EXISTS unreachable BOOLEAN NOT NULL DEFAULT FALSE;")
+                cur.execute("CREATE TABLE IF NOT EXISTS broadcasts (id SERIAL PRIMARY KEY, target VARCHAR(16) NOT NULL, from_chat_id BIGINT NOT NULL, message_id BIGINT NOT NULL, status_chat_id BIGINT NOT NULL, status_message_id BIGINT NOT NULL, last_target_id BIGINT NOT NULL, total INT NOT NULL, sent INT NOT NULL DEFAULT 0, failed INT NOT NULL DEFAULT 0, unreachable INT NOT NULL DEFAULT 0, finished BOOLEAN NOT NULL DEFAULT FALSE, created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW());")
+                cur.execute("CREATE TABLE IF NOT EXISTS game_states (game_type VARCHAR(32), chat_id BIGINT, game_id BIGINT, version INT NOT NULL, state BYTEA NOT NULL, updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), PRIMARY KEY (game_type, chat_id, game_id));")
             conn.commit()
             logger.info("Database setup complete.")
         except Exception as e: logger.error(f"Database setup failed: {e}")
-        finally: conn.close()
+        finally: release_db_connection(conn)
 
 # --- توابع کمکی ---
 async def is_owner(user_id: int) -> bool: return user_id in OWNER_IDS
 async def is_group_admin(user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     if await is_owner(user_id): return True
-    admins = await context.bot.get_chat_administrators(chat_id)
-    return user_id in {admin.user.id for admin in admins}
+    return user_id in await get_chat_admin_ids(chat_id, context)
 def convert_persian_to_english_numbers(text: str) -> str:
     if not text: return ""
     return text.translate(str.maketrans("۰۱۲۳۴۵۶۷۸۹", "0123456789"))
 
+class TTLCache:
+    """کش ساده با زمان انقضای جداگانه برای هر آیتم که در صورت پر شدن، قدیمی‌ترین استفاده (LRU) را حذف می‌کند."""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data = OrderedDict() # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# --- کش لیست ادمین‌های هر گروه ---
+ADMIN_CACHE_TTL = int(os.environ.get("ADMIN_CACHE_TTL", "300")) # مدت اعتبار لیست ادمین‌ها (ثانیه)
+ADMIN_CACHE_MAX_SIZE = int(os.environ.get("ADMIN_CACHE_MAX_SIZE", "5000"))
+ADMIN_STATUSES = ('administrator', 'creator')
+admin_cache = TTLCache(ADMIN_CACHE_MAX_SIZE)
+
+async def get_chat_admin_ids(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> frozenset:
+    """مجموعه آیدی ادمین‌های گروه را از کش یا در صورت نبود، از تلگرام برمی‌گرداند."""
+    admin_ids = admin_cache.get(chat_id)
+    if admin_ids is None:
+        admins = await context.bot.get_chat_administrators(chat_id)
+        admin_ids = frozenset(admin.user.id for admin in admins)
+        admin_cache.set(chat_id, admin_ids, ADMIN_CACHE_TTL)
+    return admin_ids
+
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """با هر ارتقا یا عزل ادمین در گروه، کش ادمین‌های آن گروه را باطل می‌کند."""
+    result = update.chat_member
+    if not result:
+        return
+    if result.old_chat_member.status in ADMIN_STATUSES or result.new_chat_member.status in ADMIN_STATUSES:
+        admin_cache.pop(result.chat.id)
+
+# --- کش کاربران و گروه‌های مسدود ---
+# لیست مسدودها در شروع برنامه در حافظه بارگذاری می‌شود تا بررسی بن در مسیر پرتکرار بدون دیتابیس انجام شود.
+BAN_CACHE_RECONCILE_INTERVAL = int(os.environ.get("BAN_CACHE_RECONCILE_INTERVAL", "300")) # فاصله همگام‌سازی کش با دیتابیس (ثانیه)
+banned_user_ids = frozenset()
+banned_group_ids = frozenset()
+ban_cache_version = 0 # با هر تغییر مستقیم کش زیاد می‌شود تا بارگذاری همزمان، تغییر تازه را بازنویسی نکند
+
+def _load_ban_lists(cur):
+    cur.execute("SELECT user_id FROM banned_users;")
+    user_ids = frozenset(row[0] for row in cur)
+    cur.execute("SELECT group_id FROM banned_groups;")
+    group_ids = frozenset(row[0] for row in cur)
+    return user_ids, group_ids
+
+async def reload_ban_cache() -> bool:
+    """کش مسدودها را از دیتابیس بازسازی می‌کند."""
+    global banned_user_ids, banned_group_ids
+    version = ban_cache_version
+    try:
+        user_ids, group_ids = await db_run(_load_ban_lists)
+    except Exception as e:
+        logger.error(f"Could not load ban lists: {e}")
+        return False
+    if version != ban_cache_version:
+        # در حین بارگذاری، یک بن/آنبن جدید ثبت شده است؛ همگام‌سازی بعدی آن را خواهد دید
+        return False
+    banned_user_ids, banned_group_ids = user_ids, group_ids
+    return True
+
+def set_user_banned(user_id: int, banned: bool):
+    global banned_user_ids, ban_cache_version
+    banned_user_ids = banned_user_ids | {user_id} if banned else banned_user_ids - {user_id}
+    ban_cache_version += 1
+
+def set_group_banned(group_id: int, banned: bool):
+    global banned_group_ids, ban_cache_version
+    banned_group_ids = banned_group_ids | {group_id} if banned else banned_group_ids - {group_id}
+    ban_cache_version += 1
+
+async def reconcile_ban_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    if await reload_ban_cache():
+        logger.info(f"Ban cache reconciled: {len(banned_user_ids)} users, {len(banned_group_ids)} groups.")
+
+# --- اطلاعات زمان اجرا ---
+# مقادیری که یک بار در شروع ربات خوانده می‌شوند تا مسیرهای پرتکرار (مثل /start) درخواست شبکه نداشته باشند.
+# یوزرنیم ربات را PTB در initialize() کش می‌کند و از context.bot.username خوانده می‌شود.
+start_message = None # پیام خوشامدگویی سفارشی: (message_id, chat_id) یا None
+start_message_loaded = False # تا وقتی False است، retry_start_message_job دوباره برای خواندن آن تلاش می‌کند
+START_MESSAGE_RETRY_MIN = float(os.environ.get("START_MESSAGE_RETRY_MIN", "5")) # اولین فاصله تلاش مجدد برای خواندن پیام خوشامدگویی (ثانیه)
+START_MESSAGE_RETRY_MAX = float(os.environ.get("START_MESSAGE_RETRY_MAX", "300")) # سقف فاصله تلاش مجدد (ثانیه)
+
+async def load_start_message() -> bool:
+    """پیام خوشامدگویی تنظیم‌شده را از دیتابیس می‌خواند؛ پس از آن فقط set_start_command آن را تغییر می‌دهد."""
+    global start_message, start_message_loaded
+    try:
+        row = await db_run(_fetchone, "SELECT message_id, chat_id FROM start_message WHERE id = 1;", None)
+    except Exception as e:
+        logger.warning(f"Could not load start message, using the default welcome until it loads: {e}")
+        return False
+    start_message = tuple(row) if row else None
+    start_message_loaded = True
+    return True
+
+async def retry_start_message_job(context: ContextTypes.DEFAULT_TYPE):
+    """اگر پیام خوشامدگویی در شروع برنامه خوانده نشد، با فاصله‌ای که هر بار دو برابر می‌شود دوباره تلاش می‌کند."""
+    if start_message_loaded:
+        return
+    if await load_start_message():
+        logger.info("Start message loaded after an earlier failure.")
+        return
+    delay = min(context.job.data * 2, START_MESSAGE_RETRY_MAX)
+    context.job_queue.run_once(retry_start_message_job, delay, data=delay)
+
+# --- ثبت کاربران (write-behind) ---
+# /start کاربر را فقط در صف حافظه قرار می‌دهد و صف به صورت دوره‌ای با یک INSERT چندردیفی در دیتابیس نوشته می‌شود.
+USER_REGISTRATION_FLUSH_INTERVAL = int(os.environ.get("USER_REGISTRATION_FLUSH_INTERVAL", "5")) # فاصله نوشتن صف (ثانیه)
+USER_SEEN_CACHE_MAX_SIZE = int(os.environ.get("USER_SEEN_CACHE_MAX_SIZE", "200000")) # کاربرانی که در این اجرا ثبت شده‌اند
+pending_user_registrations = {} # user_id -> (first_name, username)
+registered_user_ids = set()
+_user_registration_flush_lock = asyncio.Lock()
+
+def queue_user_registration(user):
+    """کاربر را برای ثبت در جدول users در صف قرار می‌دهد (کاربران ثبت شده در این اجرا نادیده گرفته می‌شوند)."""
+    if user.id in registered_user_ids:
+        return
+    if len(registered_user_ids) >= USER_SEEN_CACHE_MAX_SIZE:
+        registered_user_ids.clear()
+    registered_user_ids.add(user.id)
+    pending_user_registrations[user.id] = (user.first_name, user.username)
+
+def _insert_users(cur, rows):
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO users (user_id, first_name, username) VALUES %s ON CONFLICT (user_id) DO UPDATE SET unreachable = FALSE WHERE users.unreachable;",
+        rows,
+        page_size=1000,
+    )
+
+async def flush_user_registrations() -> int:
+    """صف ثبت کاربران را در یک تراکنش می‌نویسد و تعداد کاربران نوشته شده را برمی‌گرداند."""
+    global pending_user_registrations
+    async with _user_registration_flush_lock:
+        if not pending_user_registrations:
+            return 0
+        batch, pending_user_registrations = pending_user_registrations, {}
+        try:
+            await db_run(_insert_users, [(user_id, first_name, username) for user_id, (first_name, username) in batch.items()])
+        except Exception:
+            # کاربرانی که در این فاصله دوباره صف شده‌اند، داده جدیدتر خود را حفظ می‌کنند
+            for user_id, data in batch.items():
+                pending_user_registrations.setdefault(user_id, data)
+            raise
+        return len(batch)
+
+async def flush_user_registrations_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await flush_user_registrations()
+    except Exception as e:
+        logger.error(f"User registration flush failed: {e}")
+
 # --- مدیریت وضعیت بازی‌ها ---
 active_games = {'guess_number': {}, 'dooz': {}, 'hangman': {}, 'typing': {}, 'hokm': {}, 'connect4': {}, 'rps': {}, 'memory': {}, '2048': {}, 'samegame': {}, 'spuzzle': {}, 'doz4p': {}, 'gardone': {}}
 active_gharch_games = {}
 
+# قفل هر بازی با کلید (نوع بازی، چت، شناسه بازی)؛ قفل‌های بدون استفاده خودکار از حافظه حذف می‌شوند
+game_locks = weakref.WeakValueDictionary()
+
+def get_game_lock(game_type: str, chat_id: int, game_id: int) -> asyncio.Lock:
+    """قفل اختصاصی یک بازی را برمی‌گرداند تا حرکت‌های همان بازی به ترتیب پردازش شوند."""
+    key = (game_type, chat_id, game_id)
+    lock = game_locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        game_locks[key] = lock
+    return lock
+
+# --- پاک‌سازی بازی‌های رهاشده ---
+GAME_REAPER_INTERVAL = int(os.environ.get("GAME_REAPER_INTERVAL", "300")) # فاصله اجرای پاک‌سازی (ثانیه)
+# حداکثر زمان بی‌فعالیتی هر نوع بازی (ثانیه)؛ با متغیر محیطی GAME_IDLE_TTL_<TYPE> قابل تغییر است
+_DEFAULT_GAME_IDLE_TTLS = {
+    'hokm': 3600, 'dooz': 1800, 'connect4': 1800, 'rps': 900, 'memory': 1800,
+    '2048': 3600, 'samegame': 3600, 'spuzzle': 3600, 'doz4p': 1800, 'gardone': 3600,
+    'guess_number': 1800, 'hangman': 3600, 'typing': 600, 'gharch': 86400,
+}
+GAME_IDLE_TTLS = {
+    game_type: int(os.environ.get(f"GAME_IDLE_TTL_{game_type.upper()}", ttl))
+    for game_type, ttl in _DEFAULT_GAME_IDLE_TTLS.items()
+}
+# بازی‌هایی که مستقیماً با شناسه چت ذخیره می‌شوند (active_games[type][chat_id] = game)
+CHAT_KEYED_GAME_TYPES = ('guess_number', 'hangman', 'typing', 'gardone')
+GAME_EXPIRED_TEXT = "⌛️ این بازی به دلیل عدم فعالیت منقضی شد."
+
+# بازی‌هایی که از آخرین ذخیره تغییر کرده‌اند؛ فقط همین‌ها در flush_game_states دوباره سریال می‌شوند
+_dirty_game_ids = set() # id(game)
+_dirty_game_chats = set() # چت‌هایی که پردازش یک آپدیت یا job در آن‌ها تمام شده است
+
+def mark_game_dirty(game: dict) -> None:
+    _dirty_game_ids.add(id(game))
+
+def mark_chat_dirty(chat_id: int) -> None:
+    """
+    تمام بازی‌های چت را برای ذخیره بعدی علامت می‌زند. پس از پایان هر آپدیت صدا زده می‌شود تا
+    تغییراتی که بعد از touch_game (مثلاً پس از یک await) انجام شده‌اند هم ذخیره شوند.
+    """
+    _dirty_game_chats.add(chat_id)
+
+def touch_game(game: dict) -> None:
+    """زمان آخرین فعالیت بازی را ثبت می‌کند تا توسط پاک‌سازی حذف نشود و بازی را برای ذخیره علامت می‌زند."""
+    game['last_activity'] = time.time()
+    mark_game_dirty(game)
+
+def is_game_participant(game: dict, user_id: int) -> bool:
+    """آیا کاربر بازیکن (یا سازنده) این بازی است؛ کلیک دیگران نباید بازی رها شده را زنده نگه دارد."""
+    if user_id in (game.get('player_id'), game.get('starter_admin_id')):
+        return True
+    return any(p['id'] == user_id for key in ('players', 'players_info', 'participants') for p in game.get(key, ()))
+
+def _is_game_idle(game: dict, ttl: int, now: float) -> bool:
+    # بازی‌ای که هنوز زمان فعالیت ندارد از همین لحظه شمرده می‌شود
+    return now - game.setdefault('last_activity', now) > ttl
+
+def evict_idle_games(now: float) -> list:
+    """بازی‌های منقضی را از حافظه حذف کرده و لیست (نوع، چت، شناسه پیام) آن‌ها را برمی‌گرداند."""
+    evicted = []
+    for game_type, games_by_chat in active_games.items():
+        ttl = GAME_IDLE_TTLS.get(game_type)
+        if not ttl:
+            continue
+        for chat_id in list(games_by_chat):
+            if game_type in CHAT_KEYED_GAME_TYPES:
+                game = games_by_chat[chat_id]
+                if _is_game_idle(game, ttl, now):
+                    del games_by_chat[chat_id]
+                    evicted.append((game_type, chat_id, game.get('game_id')))
+                continue
+            chat_games = games_by_chat[chat_id]
+            for game_id in list(chat_games):
+                if _is_game_idle(chat_games[game_id], ttl, now):
+                    del chat_games[game_id]
+                    evicted.append((game_type, chat_id, game_id))
+            if not chat_games:
+                del games_by_chat[chat_id]
+
+    for chat_id in list(active_gharch_games):
+        game = active_gharch_games[chat_id]
+        if _is_game_idle(game, GAME_IDLE_TTLS['gharch'], now):
+            del active_gharch_games[chat_id]
+            evicted.append(('gharch', chat_id, game.get('pinned_message_id')))
+    return evicted
+
+async def reap_idle_games_job(context: ContextTypes.DEFAULT_TYPE):
+    """بازی‌های رهاشده را حذف و پیام آن‌ها را به «منقضی شد» تغییر می‌دهد (توسط JobQueue اجرا می‌شود)."""
+    evicted = evict_idle_games(time.time())
+    if not evicted:
+        return
+
+    edited = 0
+    for game_type, chat_id, message_id in evicted:
+        if not message_id:
+            continue
+        try:
+            await context.bot.edit_message_text(GAME_EXPIRED_TEXT, chat_id=chat_id, message_id=message_id, reply_markup=None)
+            edited += 1
+        except Exception as e:
+            logger.debug(f"Could not edit expired {game_type} message {message_id} in {chat_id}: {e}")
+
+    counts = {}
+    for game_type, _, _ in evicted:
+        counts[game_type] = counts.get(game_type, 0) + 1
+    summary = ", ".join(f"{game_type}={count}" for game_type, count in sorted(counts.items()))
+    logger.info(f"Reaped {len(evicted)} idle games ({summary}); {edited} messages marked as expired.")
+
+# --- ذخیره‌سازی پایدار وضعیت بازی‌ها ---
+GAME_STATE_BACKEND = os.environ.get("GAME_STATE_BACKEND", "postgres") # postgres یا memory
+GAME_STATE_VERSION = 7 # با تغییر ساختار دیکشنری بازی‌ها افزایش یابد؛ نسخه‌های قدیمی بازیابی نمی‌شوند
+GAME_STATE_FLUSH_INTERVAL = float(os.environ.get("GAME_STATE_FLUSH_INTERVAL", "5")) # فاصله ذخیره دسته‌ای (ثانیه)
+# وضعیت مکالمه «حدس عدد» ذخیره نمی‌شود، پس خود بازی هم ذخیره نمی‌شود
+NON_PERSISTED_GAME_TYPES = ('guess_number',)
+
+class GameStateStore(ABC):
+    """رابط پایه ذخیره وضعیت بازی‌ها؛ کلید هر ردیف (نوع بازی، چت، شناسه بازی) است."""
+
+    @abstractmethod
+    async def load_all(self) -> list:
+        """لیست (کلید، نسخه، داده سریال‌شده) همه بازی‌های ذخیره شده را برمی‌گرداند."""
+
+    @abstractmethod
+    async def write_batch(self, upserts: dict, deletes: list) -> None:
+        """تغییرات یک دوره را یکجا ذخیره می‌کند؛ در صورت خطا استثنا برمی‌گرداند."""
+
+class MemoryGameStateStore(GameStateStore):
+    """نسخه درون حافظه‌ای؛ برای اجرای بدون دیتابیس (وضعیت با ری‌استارت از بین می‌رود)."""
+
+    def __init__(self):
+        self._rows = {}
+
+    async def load_all(self) -> list:
+        return [(key, version, blob) for key, (version, blob) in self._rows.items()]
+
+    async def write_batch(self, upserts: dict, deletes: list) -> None:
+        for key in deletes:
+            self._rows.pop(key, None)
+        for key, blob in upserts.items():
+            self._rows[key] = (GAME_STATE_VERSION, blob)
+
+def _load_game_states(cur):
+    cur.execute("SELECT game_type, chat_id, game_id, version, state FROM game_states;")
+    return [((game_type, chat_id, game_id), version, bytes(state)) for game_type, chat_id, game_id, version, state in cur.fetchall()]
+
+def _write_game_states(cur, upserts: dict, deletes: list):
+    if deletes:
+        cur.executemany("DELETE FROM game_states WHERE game_type = %s AND chat_id = %s AND game_id = %s;", deletes)
+    if upserts:
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO game_states (game_type, chat_id, game_id, version, state) VALUES %s "
+            "ON CONFLICT (game_type, chat_id, game_id) DO UPDATE SET version = EXCLUDED.version, state = EXCLUDED.state, updated_at = NOW();",
+            [(*key, GAME_STATE_VERSION, psycopg2.Binary(blob)) for key, blob in upserts.items()]
+        )
+
+class PostgresGameStateStore(GameStateStore):
+    """وضعیت بازی‌ها را در جدول game_states دیتابیس اصلی نگه می‌دارد."""
+
+    async def load_all(self) -> list:
+        return await db_run(_load_game_states)
+
+    async def write_batch(self, upserts: dict, deletes: list) -> None:
+        await db_run(_write_game_states, upserts, deletes)
+
+game_state_store = MemoryGameStateStore() if GAME_STATE_BACKEND == "memory" else PostgresGameStateStore()
+_persisted_digests = {} # کلید -> خلاصه آخرین نسخه ذخیره شده
+_game_state_flush_lock = asyncio.Lock()
+
+class _GameStateUnpickler(pickle.Unpickler):
+    """
+    داده‌های خوانده شده از دیتابیس فقط می‌توانند انواع ساده‌ای باشند که در دیکشنری بازی‌ها استفاده می‌شوند؛
+    هر global دیگری (و در نتیجه اجرای کد دلخواه هنگام بازیابی) رد می‌شود.
+    """
+    ALLOWED_GLOBALS = {
+        ('builtins', 'set'), ('builtins', 'frozenset'), ('builtins', 'bytearray'),
+        ('array', 'array'), ('array', '_array_reconstructor'),
+        ('collections', 'deque'), ('datetime', 'datetime'),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self.ALLOWED_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"global '{module}.{name}' is not allowed in saved game state")
+
+def serialize_game_state(game: dict) -> bytes:
+    return pickle.dumps(game, protocol=pickle.HIGHEST_PROTOCOL)
+
+def deserialize_game_state(blob: bytes) -> dict:
+    game = _GameStateUnpickler(io.BytesIO(blob)).load()
+    if not isinstance(game, dict):
+        raise pickle.UnpicklingError(f"saved game state is a {type(game).__name__}, not a dict")
+    return game
+
+def iter_persisted_games():
+    """همه بازی‌های قابل ذخیره را به صورت (کلید، بازی) برمی‌گرداند."""
+    for game_type, games_by_chat in active_games.items():
+        if game_type in NON_PERSISTED_GAME_TYPES:
+            continue
+        for chat_id, value in games_by_chat.items():
+            if game_type in CHAT_KEYED_GAME_TYPES:
+                yield (game_type, chat_id, 0), value
+            else:
+                for game_id, game in value.items():
+                    yield (game_type, chat_id, game_id), game
+    for chat_id, game in active_gharch_games.items():
+        yield ('gharch', chat_id, 0), game
+
+async def flush_game_states() -> int:
+    """
+    بازی‌های تغییر کرده را سریال و به صورت دسته‌ای ذخیره می‌کند و بازی‌های حذف شده را پاک می‌کند.
+    تعداد ردیف‌های نوشته/حذف شده را برمی‌گرداند.
+    """
+    async with _game_state_flush_lock:
+        # بین برداشتن علامت‌ها و سریال کردن await وجود ندارد، پس تغییری گم نمی‌شود
+        dirty_ids, dirty_chats = set(_dirty_game_ids), set(_dirty_game_chats)
+        _dirty_game_ids.clear()
+        _dirty_game_chats.clear()
+        upserts, digests, live_keys = {}, {}, set()
+        for key, game in list(iter_persisted_games()):
+            live_keys.add(key)
+            if key in _persisted_digests and id(game) not in dirty_ids and key[1] not in dirty_chats:
+                continue
+            try:
+                blob = serialize_game_state(game)
+            except Exception as e:
+                logger.warning(f"Could not serialize game {key}: {e}")
+                continue
+            digest = hashlib.blake2b(blob, digest_size=16).digest()
+            if _persisted_digests.get(key) != digest:
+                upserts[key] = blob
+                digests[key] = digest
+        deletes = [key for key in _persisted_digests if key not in live_keys]
+
+        if not upserts and not deletes:
+            return 0
+        try:
+            await game_state_store.write_batch(upserts, deletes)
+        except Exception:
+            # در flush بعدی دوباره تلاش می‌شود
+            _dirty_game_ids.update(dirty_ids)
+            _dirty_game_chats.update(dirty_chats)
+            raise
+        for key in deletes:
+            _persisted_digests.pop(key, None)
+        _persisted_digests.update(digests)
+        return len(upserts) + len(deletes)
+
+async def flush_game_states_job(context: ContextTypes.DEFAULT_TYPE):
+    """ذخیره دوره‌ای وضعیت بازی‌ها (توسط JobQueue اجرا می‌شود)."""
+    try:
+        await flush_game_states()
+    except Exception as e:
+        logger.error(f"Game state flush failed: {e}")
+
+async def restore_game_states(application: Application) -> int:
+    """بازی‌های ذخیره شده را به حافظه برمی‌گرداند و مراحل زمان‌بندی شده آن‌ها را دوباره برنامه‌ریزی می‌کند."""
+    try:
+        rows = await game_state_store.load_all()
+    except Exception as e:
+        logger.error(f"Could not load saved game states: {e}")
+        return 0
+
+    restored = 0
+    for key, version, blob in rows:
+        # ردیف‌های نامعتبر در اولین ذخیره بعدی حذف می‌شوند
+        _persisted_digests[key] = None
+        if version != GAME_STATE_VERSION:
+            continue
+        try:
+            game = deserialize_game_state(blob)
+        except Exception as e:
+            logger.warning(f"Could not restore game {key}: {e}")
+            continue
+        game_type, chat_id, game_id = key
+        if game_type == 'gharch':
+            active_gharch_games[chat_id] = game
+        elif game_type in CHAT_KEYED_GAME_TYPES:
+            active_games[game_type][chat_id] = game
+        elif game_type in active_games:
+            active_games[game_type].setdefault(chat_id, {})[game_id] = game
+        else:
+            continue
+        _persisted_digests[key] = hashlib.blake2b(blob, digest_size=16).digest()
+        restored += 1
+
+        # مراحلی که قبل از توقف ربات زمان‌بندی شده بودند
+        if game_type == 'hokm' and game.get('status') == 'showing_trick':
+            application.job_queue.run_once(hokm_clear_trick_job, HOKM_TRICK_REVEAL_DELAY, chat_id=chat_id, data=game_id)
+        elif game_type == 'memory' and game.get('second_card'):
+            application.job_queue.run_once(memory_check_pair_job, MEMORY_REVEAL_DELAY, chat_id=chat_id, data=game_id)
+    return restored
+
+# --- پردازش همزمان آپدیت‌ها ---
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64")) # حداکثر آپدیت‌های همزمان (۱ یعنی ترتیبی)
+# در حین اجرای هندلر یک آپدیت True است (قفل چت در دست است)؛ TelegramRateLimiter از آن استفاده می‌کند
+handling_update = contextvars.ContextVar("handling_update", default=False)
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    آپدیت‌های چت‌های مختلف را همزمان پردازش می‌کند ولی آپدیت‌های یک چت را به ترتیب؛
+    ConversationHandler ها به پردازش ترتیبی در هر چت وابسته‌اند.
+    """
+    __slots__ = ("_chat_locks",)
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def _serial_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        handling_update.set(True) # هر آپدیت در تسک جداگانه خود اجرا می‌شود
+        key = self._serial_key(update)
+        if key is None:
+            await coroutine
+            return
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._chat_locks[key] = lock
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            if key[0] == 'chat':
+                mark_chat_dirty(key[1])
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- محدودکننده نرخ درخواست‌های خروجی به تلگرام ---
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.environ.get("RATE_LIMIT_GLOBAL_PER_SECOND", "30")) # سقف کل پیام‌های ربات در ثانیه
+RATE_LIMIT_PRIVATE_PER_SECOND = float(os.environ.get("RATE_LIMIT_PRIVATE_PER_SECOND", "1")) # سقف پیام در هر چت خصوصی
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.environ.get("RATE_LIMIT_GROUP_PER_MINUTE", "20")) # سقف پیام در هر گروه
+RATE_LIMIT_CHAT_BURST = int(os.environ.get("RATE_LIMIT_CHAT_BURST", "5")) # تعداد پیام پشت سر هم مجاز در یک چت
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "3")) # تلاش مجدد پس از RetryAfter
+RATE_LIMIT_MAX_CHAT_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_CHAT_BUCKETS", "10000"))
+# فقط متدهای ارسال/ویرایش پیام مشمول سقف کلی هستند؛ متدهای خواندنی (get_chat_member و ...) محدود نمی‌شوند
+RATE_LIMITED_ENDPOINT_PREFIXES = ('send', 'edit', 'forward', 'copy')
+# سقف هر چت فقط برای پیام‌های جدید است؛ ویرایش صفحه بازی در هر حرکت نباید پشت سقف ۲۰ پیام در دقیقه گروه بماند
+CHAT_LIMITED_ENDPOINT_PREFIXES = ('send', 'forward', 'copy')
+PRIORITY_ENDPOINTS = ('answerCallbackQuery',)
+
+class TokenBucket:
+    """
+    سطل توکن با رزرو: هر درخواست یک توکن برمی‌دارد (حتی اگر موجودی منفی شود)
+    و به اندازه بدهی خود صبر می‌کند؛ بنابراین درخواست‌ها به ترتیب رسیدن نوبت می‌گیرند.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """یک توکن رزرو می‌کند و مدت انتظار لازم (ثانیه) را برمی‌گرداند."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    async def acquire(self):
+        await asyncio.sleep(self.reserve())
+        # ممکن است در حین انتظار RetryAfter دریافت شده باشد
+        await self.wait_unblocked()
+
+    async def wait_unblocked(self):
+        """فقط تا پایان توقف RetryAfter صبر می‌کند، بدون مصرف توکن."""
+        while (delay := self.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    تمام درخواست‌های خروجی application.bot از این کلاس عبور می‌کنند (بازی‌ها، ارسال همگانی، track_chats و ...).
+    - پیام‌ها سقف کلی را رعایت می‌کنند؛ پیام‌های جدیدی که خارج از هندلرها ارسال می‌شوند (job ها، ارسال همگانی)
+      سقف هر چت (خصوصی: در ثانیه، گروه: در دقیقه) را هم رعایت می‌کنند.
+    - هندلرها قفل چت را در دست دارند، پس پشت سقف هر چت منتظر نمی‌مانند و فقط RetryAfter آن‌ها را متوقف می‌کند.
+    - پاسخ به دکمه‌ها (answerCallbackQuery) در صف نمی‌ماند ولی از سهمیه کلی کم می‌کند؛ در صورت RetryAfter تکرار نمی‌شود.
+    - در صورت RetryAfter، چت مربوطه (یا کل ربات) به مدت اعلام شده متوقف و درخواست تکرار می‌شود.
+    """
+
+    def __init__(self):
+        self._global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND, max(1.0, RATE_LIMIT_GLOBAL_PER_SECOND))
+        self._chat_buckets = {}
+        self.delayed = 0
+        self.retry_afters = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _get_chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= RATE_LIMIT_MAX_CHAT_BUCKETS:
+                self._chat_buckets = {key: b for key, b in self._chat_buckets.items() if not b.is_idle()}
+            # آیدی منفی یا رشته‌ای (@channel) یعنی گروه/کانال
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = RATE_LIMIT_GROUP_PER_MINUTE / 60 if is_group else RATE_LIMIT_PRIVATE_PER_SECOND
+            bucket = TokenBucket(rate, max(1, RATE_LIMIT_CHAT_BURST))
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args if rate_limit_args is not None else RATE_LIMIT_MAX_RETRIES
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        is_priority = endpoint in PRIORITY_ENDPOINTS
+        is_limited = not is_priority and endpoint.startswith(RATE_LIMITED_ENDPOINT_PREFIXES)
+        chat_bucket = self._get_chat_bucket(chat_id) if is_limited and chat_id is not None else None
+        # هندلرها و ویرایش‌ها فقط منتظر توقف RetryAfter چت می‌مانند، نه سهمیه آن
+        paces_chat = chat_bucket is not None and not handling_update.get() and endpoint.startswith(CHAT_LIMITED_ENDPOINT_PREFIXES)
+
+        for attempt in range(max_retries + 1):
+            if is_priority:
+                self._global_bucket.reserve()
+            elif is_limited:
+                started = time.monotonic()
+                if paces_chat:
+                    await chat_bucket.acquire()
+                elif chat_bucket is not None:
+                    await chat_bucket.wait_unblocked()
+                await self._global_bucket.acquire()
+                if time.monotonic() - started > 0.05:
+                    self.delayed += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_afters += 1
+                if is_priority:
+                    # تا پایان توقف، callback معمولاً منقضی شده است؛ تکرار فایده ندارد و نباید بقیه ربات را متوقف کند
+                    logger.warning(f"RetryAfter on {endpoint}; not retrying.")
+                    raise
+                if attempt == max_retries:
+                    logger.error(f"RetryAfter on {endpoint} for chat {chat_id} after {max_retries} retries.")
+                    raise
+                delay = float(e.retry_after) + 0.1
+                logger.warning(f"RetryAfter on {endpoint} for chat {chat_id}; backing off {delay:.1f}s.")
+                if chat_bucket is not None:
+                    chat_bucket.block(delay)
+                elif chat_id is not None:
+                    # درخواست‌های بدون سهمیه که به یک چت مربوط‌اند کل ربات را متوقف نمی‌کنند
+                    await asyncio.sleep(delay)
+                else:
+                    self._global_bucket.block(delay)
+                    await asyncio.sleep(delay)
+
+# --- کش عضویت در کانال اجباری ---
+CHANNEL_MEMBER_STATUSES = ('member', 'administrator', 'creator')
+MEMBERSHIP_CACHE_POSITIVE_TTL = int(os.environ.get("MEMBERSHIP_CACHE_POSITIVE_TTL", "600")) # مدت اعتبار «عضو است» (ثانیه)
+MEMBERSHIP_CACHE_NEGATIVE_TTL = int(os.environ.get("MEMBERSHIP_CACHE_NEGATIVE_TTL", "30")) # مدت اعتبار «عضو نیست» (ثانیه)
+MEMBERSHIP_CACHE_MAX_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_MAX_SIZE", "20000"))
+membership_cache = TTLCache(MEMBERSHIP_CACHE_MAX_SIZE)
+
+async def is_channel_member(user_id: int, context: ContextTypes.DEFAULT_TYPE, force_refresh: bool = False) -> bool:
+    """
+    عضویت کاربر در FORCED_JOIN_CHANNEL را با استفاده از کش برمی‌گرداند.
+    خطای API به فراخوان منتقل می‌شود و در کش ذخیره نمی‌شود.
+    """
+    if not force_refresh:
+        cached = membership_cache.get(user_id)
+        if cached is not None:
+            return cached
+    member = await context.bot.get_chat_member(chat_id=FORCED_JOIN_CHANNEL, user_id=user_id)
+    is_member = member.status in CHANNEL_MEMBER_STATUSES
+    ttl = MEMBERSHIP_CACHE_POSITIVE_TTL if is_member else MEMBERSHIP_CACHE_NEGATIVE_TTL
+    membership_cache.set(user_id, is_member, ttl)
+    return is_member
+
 # --- ##### تغییر کلیدی: منطق جدید عضویت اجباری و بن ##### ---
 async def check_ban_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """چک می‌کند که آیا کاربر یا گروه بن شده است یا خیر. اگر گروه بن باشد، ربات خارج می‌شود."""
@@ -933,30 +1836,16 @@ async def check_ban_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     chat = update.effective_chat
     if not user: return True # اگر کاربری وجود نداشت، بن شده در نظر بگیر
 
-    conn = get_db_connection()
-    if not conn: return False # اگر دیتابیس وصل نشد، فرض بر عدم بن بودن است
-    
-    is_banned = False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM banned_users WHERE user_id = %s;", (user.id,))
-            if cur.fetchone():
-                is_banned = True
-            
-            if not is_banned and chat.type != 'private':
-                cur.execute("SELECT 1 FROM banned_groups WHERE group_id = %s;", (chat.id,))
-                if cur.fetchone():
-                    is_banned = True
-                    try:
-                        await context.bot.leave_chat(chat.id)
-                    except Exception:
-                        pass
-    except Exception as e:
-        logger.error(f"Error checking ban status: {e}")
-    finally:
-        conn.close()
-    
-    return is_banned
+    # بررسی فقط از روی کش حافظه انجام می‌شود (بدون دیتابیس)
+    if user.id in banned_user_ids:
+        return True
+    if chat.type != 'private' and chat.id in banned_group_ids:
+        try:
+            await context.bot.leave_chat(chat.id)
+        except Exception:
+            pass
+        return True
+    return False
 
 async def check_join_for_alert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
@@ -967,8 +1856,7 @@ async def check_join_for_alert(update: Update, context: ContextTypes.DEFAULT_TYP
         return True
 
     try:
-        member = await context.bot.get_chat_member(chat_id=FORCED_JOIN_CHANNEL, user_id=user.id)
-        if member.status in ['member', 'administrator', 'creator']:
+        if await is_channel_member(user.id, context):
             return True
     except Exception as e:
         logger.warning(f"Could not check channel membership for alert: {user.id}: {e}")
@@ -990,8 +1878,7 @@ async def check_forced_join(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return True
 
     try:
-        member = await context.bot.get_chat_member(chat_id=FORCED_JOIN_CHANNEL, user_id=user.id)
-        if member.status in ['member', 'administrator', 'creator']:
+        if await is_channel_member(user.id, context):
             return True
     except Exception as e:
         logger.warning(f"Could not check channel membership for {user.id}: {e}")
@@ -1029,9 +1916,7 @@ async def rsgame_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_member = True
     else:
         try:
-            member = await context.bot.get_chat_member(chat_id=FORCED_JOIN_CHANNEL, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                is_member = True
+            is_member = await is_channel_member(user_id, context)
         except Exception:
             is_member = False
 
@@ -1077,14 +1962,14 @@ async def rsgame_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif update.callback_query:
             await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def rsgame_check_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rsgame_check_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     """بررسی مجدد عضویت پس از کلیک روی دکمه 'عضو شدم'."""
     query = update.callback_query
     user = query.from_user
     
     try:
-        member = await context.bot.get_chat_member(chat_id=FORCED_JOIN_CHANNEL, user_id=user.id)
-        if member.status in ['member', 'administrator', 'creator']:
+        # کاربر ادعا می‌کند تازه عضو شده، پس کش را نادیده می‌گیریم
+        if await is_channel_member(user.id, context, force_refresh=True):
             await query.answer("عضویت شما تایید شد!")
             # حالا که عضویت تایید شد، پنل اصلی را به او نشان می‌دهیم
             await rsgame_command(update, context)
@@ -1093,12 +1978,14 @@ async def rsgame_check_join_callback(update: Update, context: ContextTypes.DEFAU
     except Exception:
         await query.answer("خطایی در بررسی عضویت رخ داد. لطفاً لحظاتی دیگر دوباره تلاش کنید.", show_alert=True)
 
-async def rsgame_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rsgame_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     """مدیریت دکمه‌های پنل اصلی بازی‌ها و بررسی مالکیت پنل."""
     query = update.callback_query
+    if data[-1] == "pv":
+        await rsgame_pv_callback(update, context)
+        return
     
     # -- بخش جدید: بررسی مالکیت پنل --
-    data = query.data.split('_')
     try:
         # آخرین بخش callback_data همیشه آیدی کاربر است
         target_user_id = int(data[-1]) 
@@ -1194,12 +2081,11 @@ async def rsgame_callback_handler(update: Update, context: ContextTypes.DEFAULT_
 # توابع کمکی حکم (card_to_persian, create_deck, ...) همانند قبل باقی می‌مانند
 # ... (کد بازی حکم در اینجا قرار می‌گیرد - بدون تغییر)
 
-async def rsgame_close_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rsgame_close_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     """پنل بازی را می‌بندد و مالکیت آن را چک می‌کند."""
     query = update.callback_query
     
     # --- بخش امنیتی جدید ---
-    data = query.data.split('_')
     try:
         target_user_id = int(data[-1])
     except (ValueError, IndexError):
@@ -1222,41 +2108,44 @@ async def rsgame_close_callback(update: Update, context: ContextTypes.DEFAULT_TY
             pass
 
 # --- توابع کمکی حکم (بدون تغییر در منطق) ---
+HOKM_TRICK_REVEAL_DELAY = 2.5 # مدت نمایش کارت‌های دست تمام‌شده قبل از پاک شدن میز (ثانیه)
+
+# کارت‌ها اعداد ۰ تا ۵۱ هستند: suit * 13 + (rank - 2)؛ rank از ۲ تا ۱۴ است (J=11, Q=12, K=13, A=14)
+HOKM_SUITS = ('S', 'H', 'D', 'C')  # Spades, Hearts, Diamonds, Clubs (شماره خال = اندیس)
+HOKM_SUIT_EMOJIS = ('♠️', '♥️', '♦️', '♣️')
+CARD_SUIT = bytes(card // 13 for card in range(52))
+CARD_RANK = bytes(card % 13 + 2 for card in range(52))
+_RANK_NAMES = {11: 'J', 12: 'Q', 13: 'K', 14: 'A'}
+CARD_DISPLAY = tuple(f"{HOKM_SUIT_EMOJIS[CARD_SUIT[card]]} {_RANK_NAMES.get(CARD_RANK[card], CARD_RANK[card])}" for card in range(52))
+# ترتیب دلخواه دست: گشنیز، خشت، پیک، دل و در هر خال از بزرگ به کوچک
+_HAND_SUIT_ORDER = {'C': 0, 'D': 1, 'S': 2, 'H': 3}
+CARD_SORT_KEY = bytes(_HAND_SUIT_ORDER[HOKM_SUITS[CARD_SUIT[card]]] * 13 + (14 - CARD_RANK[card]) for card in range(52))
+# ارزش هر کارت برای تعیین برنده دست: CARD_VALUES[hokm_suit][trick_suit][card]
+# کارت‌های حکم بالاترین ارزش را دارند و کارت‌های خال زمین از سایر خال‌ها بالاترند
+CARD_VALUES = tuple(
+    tuple(
+        bytes(CARD_RANK[card] + (200 if CARD_SUIT[card] == hokm_suit else 100 if CARD_SUIT[card] == trick_suit else 0) for card in range(52))
+        for trick_suit in range(4)
+    )
+    for hokm_suit in range(4)
+)
+ACE_OF_SPADES = HOKM_SUITS.index('S') * 13 + (14 - 2)
 
 def create_deck():
-    """یک دسته کارت مرتب شده ۵۲تایی ایجاد و آن را بُر می‌زند."""
-    suits = ['S', 'H', 'D', 'C']  # Spades, Hearts, Diamonds, Clubs
-    ranks = list(range(2, 15))  # 2-10, J(11), Q(12), K(13), A(14)
-    deck = [f"{s}{r}" for s in suits for r in ranks]
+    """یک دسته کارت ۵۲تایی ایجاد و آن را بُر می‌زند."""
+    deck = bytearray(range(52))
     random.shuffle(deck)
     return deck
 
 def card_to_persian(card):
     """کارت را به فرمت فارسی با ایموجی تبدیل می‌کند."""
-    if not card: return "🃏"
-    suits = {'S': '♠️', 'H': '♥️', 'D': '♦️', 'C': '♣️'}
-    ranks = {11: 'J', 12: 'Q', 13: 'K', 14: 'A'}
-    suit, rank = card[0], int(card[1:])
-    rank_display = str(ranks.get(rank, rank))
-    return f"{suits[suit]} {rank_display}"
-
-def sort_hand_custom(hand):
-    """دست بازیکن را بر اساس ترتیب سفارشی خال‌ها و سپس ارزش کارت مرتب می‌کند."""
-    if not hand:
-        return []
-    # ترتیب دلخواه شما: گشنیز، خشت، پیک، دل
-    suit_order = {'C': 0, 'D': 1, 'S': 2, 'H': 3}
-    return sorted(hand, key=lambda card: (suit_order[card[0]], -int(card[1:])))
-
-def get_card_value(card, hokm_suit, trick_suit):
-    """ارزش عددی یک کارت را برای مقایسه و تعیین برنده دست محاسبه می‌کند."""
-    suit, rank = card[0], int(card[1:])
-    value = rank
-    if suit == hokm_suit:
-        value += 200  # کارت‌های حکم بالاترین ارزش را دارند
-    elif suit == trick_suit:
-        value += 100  # کارت‌های خال زمین ارزش بیشتری از سایر خال‌ها دارند
-    return value
+    if card is None: return "🃏"
+    return CARD_DISPLAY[card]
+
+def sort_hokm_hands(game):
+    """دست همه بازیکنان را یک بار پس از پخش کارت مرتب می‌کند تا در رندر و بازی دوباره مرتب نشوند."""
+    for pid, hand in game['hands'].items():
+        game['hands'][pid] = bytearray(sorted(hand, key=CARD_SORT_KEY.__getitem__))
 
 async def render_hokm_board(game: dict, context: ContextTypes.DEFAULT_TYPE):
     """صفحه بازی (متن و دکمه‌ها) را بر اساس وضعیت فعلی بازی تولید می‌کند."""
@@ -1294,7 +2183,7 @@ async def render_hokm_board(game: dict, context: ContextTypes.DEFAULT_TYPE):
             ])
 
     # بخش نمایش وضعیت و امتیازات
-    hokm_suit_fa = card_to_persian(f"{game['hokm_suit']}2")[0] if game.get('hokm_suit') else '❓'
+    hokm_suit_fa = HOKM_SUIT_EMOJIS[game['hokm_suit']] if game.get('hokm_suit') is not None else '❓'
     hakem_name = game.get('hakem_name', '...')
     
     if game['mode'] == '4p':
@@ -1318,23 +2207,96 @@ async def render_hokm_board(game: dict, context: ContextTypes.DEFAULT_TYPE):
     elif game['status'] == 'playing' and game.get('turn_index') is not None:
         current_player_id = game['players'][game['turn_index']]['id']
         if current_player_id in game['hands']:
-            player_hand = sort_hand_custom(game['hands'][current_player_id])
+            player_hand = game['hands'][current_player_id]
             card_buttons = [InlineKeyboardButton(str(i + 1), callback_data=f"hokm_play_{game_id}_{i}") for i in range(len(player_hand))]
             for i in range(0, len(card_buttons), 7):
                 keyboard.append(card_buttons[i:i+7])
     
     return InlineKeyboardMarkup(keyboard)
 
+async def hokm_clear_trick_job(context: ContextTypes.DEFAULT_TYPE):
+    """میز را پس از نمایش موقت برنده دست پاک کرده و بازی را ادامه می‌دهد (توسط JobQueue اجرا می‌شود)."""
+    try:
+        await _hokm_clear_trick(context)
+    finally:
+        # تغییرات بعد از touch_game (پس از await ها) هم باید ذخیره شوند
+        mark_chat_dirty(context.job.chat_id)
+
+async def _hokm_clear_trick(context: ContextTypes.DEFAULT_TYPE):
+    chat_id, game_id = context.job.chat_id, context.job.data
+    async with get_game_lock('hokm', chat_id, game_id):
+        game = active_games['hokm'].get(chat_id, {}).get(game_id)
+        if not game or game['status'] != 'showing_trick':
+            return
+        touch_game(game)
+
+        game['status'] = 'playing'
+        if game['mode'] == '4p':
+            round_over = game['trick_scores']['A'] == 7 or game['trick_scores']['B'] == 7
+        else:
+            round_over = any(score == 7 for score in game['trick_scores'].values())
+
+        game['current_trick'] = [] # پاک کردن میز
+
+        if not round_over:
+            turn_player_name = game['players'][game['turn_index']]['name']
+            reply_markup = await render_hokm_board(game, context)
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=game_id, text=f"حکم: {HOKM_SUIT_EMOJIS[game['hokm_suit']]}\n\nنوبت {turn_player_name} است.", reply_markup=reply_markup)
+        else:
+            # --- دور تمام شده، امتیاز را ثبت کن ---
+            if game['mode'] == '4p':
+                winning_team_name = 'A' if game['trick_scores']['A'] == 7 else 'B'
+                game['game_scores'][winning_team_name] += 1
+                winner_display_name = f"تیم {winning_team_name}"
+                game_over = game['game_scores'][winning_team_name] == 7
+            else:
+                round_winner_id = next(pid for pid, score in game['trick_scores'].items() if score == 7)
+                winner_display_name = next(p['name'] for p in game['players'] if p['id'] == round_winner_id)
+                game['game_scores'][round_winner_id] += 1
+                game_over = any(score == 7 for score in game['game_scores'].values())
+
+            if game_over:
+                # بازی قبل از await حذف می‌شود تا کلیک‌های بعدی آن را فعال نبینند
+                active_games['hokm'].get(chat_id, {}).pop(game_id, None)
+                await context.bot.edit_message_text(chat_id=chat_id, message_id=game_id, text=f"🏆 **بازی تمام شد!** 🏆\n\nبرنده نهایی: **{winner_display_name}**", parse_mode=ParseMode.MARKDOWN)
+                return
+        
+            # --- شروع دور جدید ---
+            current_hakem_index = next(i for i, p in enumerate(game['players']) if p['id'] == game['hakem_id'])
+            if game['mode'] == '4p':
+                hakem_team = 'A' if current_hakem_index in [0, 2] else 'B'
+                next_hakem_index = current_hakem_index if winning_team_name == hakem_team else (current_hakem_index + 1) % 4
+            else:
+                round_winner_id = next(pid for pid, score in game['trick_scores'].items() if score == 7)
+                next_hakem_index = current_hakem_index if round_winner_id == game['hakem_id'] else (current_hakem_index + 1) % 2
+        
+            p_ids = [p['id'] for p in game['players']]
+            game.update({ 
+                "status": "dealing_first_5", "deck": create_deck(), 
+                "hands": {pid: [] for pid in p_ids},
+                "trick_scores": {'A': 0, 'B': 0} if game['mode'] == '4p' else {pid: 0 for pid in p_ids} 
+            })
+            for _ in range(5):
+                for p in game['players']: game['hands'][p['id']].append(game['deck'].pop(0))
+            sort_hokm_hands(game)
+        
+            game['hakem_id'] = game['players'][next_hakem_index]['id']
+            game['hakem_name'] = game['players'][next_hakem_index]['name']
+            game['status'] = 'hakem_choosing'
+            game['turn_index'] = next_hakem_index
+
+            reply_markup = await render_hokm_board(game, context)
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=game_id, text=f"این دست تمام شد! برنده: {winner_display_name}\n\n-- دور جدید --\nحاکم جدید: {game['hakem_name']}\nمنتظر انتخاب حکم...", reply_markup=reply_markup)
+
 # --- تابع اصلی و اصلاح شده حکم ---
 
-async def hokm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def hokm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat_id
     
     # if await check_ban_status(update, context): return
     
-    data = query.data.split('_')
     action = data[1]
 
     # --- بلوک ۱: شروع بازی ---
@@ -1386,265 +2348,247 @@ async def hokm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("خطا در پردازش درخواست.", show_alert=True)
         return
 
-    if chat_id not in active_games['hokm'] or game_id not in active_games['hokm'][chat_id]:
-        await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
+    if action == "join" and not await check_join_for_alert(update, context):
         return
-        
-    game = active_games['hokm'][chat_id][game_id]
 
-    # --- ساختار جدید با elif ---
-    if action == "join":
-        if not await check_join_for_alert(update, context):
-            return
-            
-        if any(p['id'] == user.id for p in game['players']):
-            await query.answer("شما قبلاً به بازی پیوسته‌اید!", show_alert=True)
+    # کلیک‌های بازی و job پاک کردن میز با قفل اختصاصی همان بازی به ترتیب اعمال می‌شوند
+    async with get_game_lock('hokm', chat_id, game_id):
+        game = active_games['hokm'].get(chat_id, {}).get(game_id)
+        if not game:
+            await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
             return
-            
-        max_players = 4 if game['mode'] == '4p' else 2
-        if len(game['players']) >= max_players:
-            await query.answer("ظرفیت بازی تکمیل است.", show_alert=True)
-            return
-            await query.answer()
-        game['players'].append({'id': user.id, 'name': user.first_name})
-        num_players = len(game['players'])
+        if is_game_participant(game, user.id):
+            touch_game(game)
 
-        if num_players < max_players:
-            keyboard = [[InlineKeyboardButton(f"پیوستن به بازی ({num_players}/{max_players})", callback_data=f"hokm_join_{game_id}")]]
-            player_names = "، ".join([p['name'] for p in game['players']])
-            await query.edit_message_text(f"بازی حکم منتظر بازیکنان...\n\nبازیکنان فعلی: {player_names}\n\n( @RHINOSOUL_TM برای پیوستن به بازی، باید در کانال عضو باشید)", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            p_ids = [p['id'] for p in game['players']]
-            game.update({
-                "status": "dealing_first_5", "deck": create_deck(), "hands": {pid: [] for pid in p_ids},
-                "hakem_id": None, "hakem_name": None, "turn_index": 0, "hokm_suit": None, "current_trick": [],
-                "trick_scores": {'A': 0, 'B': 0} if game['mode'] == '4p' else {pid: 0 for pid in p_ids},
-                "game_scores": game.get('game_scores', {'A': 0, 'B': 0} if game['mode'] == '4p' else {pid: 0 for pid in p_ids})
-            })
-
-            for _ in range(5):
-                for p in game['players']: game['hands'][p['id']].append(game['deck'].pop(0))
+        # --- ساختار جدید با elif ---
+        if action == "join":
+            if any(p['id'] == user.id for p in game['players']):
+                await query.answer("شما قبلاً به بازی پیوسته‌اید!", show_alert=True)
+                return
             
-            hakem_p = next((p for p in game['players'] if 'S14' in game['hands'][p['id']]), game['players'][0])
-            game.update({"hakem_id": hakem_p['id'], "hakem_name": hakem_p['name'], "status": 'hakem_choosing'})
-            game['turn_index'] = next(i for i, p in enumerate(game['players']) if p['id'] == hakem_p['id'])
+            max_players = 4 if game['mode'] == '4p' else 2
+            if len(game['players']) >= max_players:
+                await query.answer("ظرفیت بازی تکمیل است.", show_alert=True)
+                return
+                await query.answer()
+            game['players'].append({'id': user.id, 'name': user.first_name})
+            touch_game(game)
+            num_players = len(game['players'])
+
+            if num_players < max_players:
+                keyboard = [[InlineKeyboardButton(f"پیوستن به بازی ({num_players}/{max_players})", callback_data=f"hokm_join_{game_id}")]]
+                player_names = "، ".join([p['name'] for p in game['players']])
+                await query.edit_message_text(f"بازی حکم منتظر بازیکنان...\n\nبازیکنان فعلی: {player_names}\n\n( @RHINOSOUL_TM برای پیوستن به بازی، باید در کانال عضو باشید)", reply_markup=InlineKeyboardMarkup(keyboard))
+            else:
+                p_ids = [p['id'] for p in game['players']]
+                game.update({
+                    "status": "dealing_first_5", "deck": create_deck(), "hands": {pid: [] for pid in p_ids},
+                    "hakem_id": None, "hakem_name": None, "turn_index": 0, "hokm_suit": None, "current_trick": [],
+                    "trick_scores": {'A': 0, 'B': 0} if game['mode'] == '4p' else {pid: 0 for pid in p_ids},
+                    "game_scores": game.get('game_scores', {'A': 0, 'B': 0} if game['mode'] == '4p' else {pid: 0 for pid in p_ids})
+                })
+
+                for _ in range(5):
+                    for p in game['players']: game['hands'][p['id']].append(game['deck'].pop(0))
+                sort_hokm_hands(game)
             
-            reply_markup = await render_hokm_board(game, context)
-            await query.edit_message_text(f"بازیکنان کامل شدند!\nحاکم: {game['hakem_name']}\n\nلطفا حکم را انتخاب کنید.", reply_markup=reply_markup)
-
-    elif action == "choose":
-        if user.id != game.get('hakem_id'):
-            await query.answer("شما حاکم نیستید!", show_alert=True)
-            return
-        if game['status'] != 'hakem_choosing':
-            await query.answer("الان زمان انتخاب حکم نیست!", show_alert=True)
-            return
+                hakem_p = next((p for p in game['players'] if ACE_OF_SPADES in game['hands'][p['id']]), game['players'][0])
+                game.update({"hakem_id": hakem_p['id'], "hakem_name": hakem_p['name'], "status": 'hakem_choosing'})
+                game['turn_index'] = next(i for i, p in enumerate(game['players']) if p['id'] == hakem_p['id'])
             
-        game['hokm_suit'] = data[3]
-        
-        for p in game['players']:
-            while len(game['hands'][p['id']]) < 13: 
-                if not game['deck']: break
-                game['hands'][p['id']].append(game['deck'].pop(0))
-        
-        game['status'] = 'playing'
-        game['turn_index'] = next(i for i, p in enumerate(game['players']) if p['id'] == game['hakem_id'])
-        turn_player_name = game['players'][game['turn_index']]['name']
-        
-        reply_markup = await render_hokm_board(game, context)
-        await query.edit_message_text(f"بازی شروع شد! حکم: {card_to_persian(game['hokm_suit']+'2')[0]}\n\nنوبت {turn_player_name} است.", reply_markup=reply_markup)
+                reply_markup = await render_hokm_board(game, context)
+                await query.edit_message_text(f"بازیکنان کامل شدند!\nحاکم: {game['hakem_name']}\n\nلطفا حکم را انتخاب کنید.", reply_markup=reply_markup)
 
-    elif action == "showhand":
-        if not any(p['id'] == user.id for p in game['players']):
-            await query.answer("شما بازیکن این مسابقه نیستید!", show_alert=True)
-            return
-        hand = sort_hand_custom(game['hands'].get(user.id, []))
-        hand_str = "\n".join([f"{NUMBER_EMOJIS[i]} {card_to_persian(c)}" for i, c in enumerate(hand)]) or "شما کارتی در دست ندارید."
-        await query.answer(f"دست شما:\n{hand_str}", show_alert=True)
-
-    elif action == "play":
-        if game['status'] != 'playing' or user.id != game['players'][game['turn_index']]['id']:
-            await query.answer("نوبت شما نیست!", show_alert=True)
-            return
+        elif action == "choose":
+            if user.id != game.get('hakem_id'):
+                await query.answer("شما حاکم نیستید!", show_alert=True)
+                return
+            if game['status'] != 'hakem_choosing':
+                await query.answer("الان زمان انتخاب حکم نیست!", show_alert=True)
+                return
+            
+            if len(data) < 4 or data[3] not in HOKM_SUITS:
+                await query.answer("خطای دکمه.", show_alert=True)
+                return
+            game['hokm_suit'] = HOKM_SUITS.index(data[3])
         
-        card_index = int(data[3])
-        hand = sort_hand_custom(game['hands'][user.id]) 
-        if not (0 <= card_index < len(hand)):
-            await query.answer("شماره کارت نامعتبر است.", show_alert=True)
-            return
+            for p in game['players']:
+                while len(game['hands'][p['id']]) < 13: 
+                    if not game['deck']: break
+                    game['hands'][p['id']].append(game['deck'].pop(0))
+            sort_hokm_hands(game)
         
-        card_played = hand[card_index]
-        if game['current_trick']:
-            trick_suit = game['current_trick'][0]['card'][0]
-            if any(c.startswith(trick_suit) for c in hand) and not card_played.startswith(trick_suit):
-                await query.answer(f"شما باید از خال زمین ({card_to_persian(trick_suit+'2')[0]}) بازی کنید!", show_alert=True)
-                return
-
-        game['hands'][user.id].remove(card_played)
-        game['current_trick'].append({'player_id': user.id, 'card': card_played})
-
-        num_players = len(game['players'])
-        if len(game['current_trick']) < num_players:
-            game['turn_index'] = (game['turn_index'] + 1) % num_players
+            game['status'] = 'playing'
+            game['turn_index'] = next(i for i, p in enumerate(game['players']) if p['id'] == game['hakem_id'])
             turn_player_name = game['players'][game['turn_index']]['name']
+        
             reply_markup = await render_hokm_board(game, context)
-            await query.edit_message_text(f"حکم: {card_to_persian(game['hokm_suit']+'2')[0]}\n\nنوبت {turn_player_name} است.", reply_markup=reply_markup)
-            return
+            await query.edit_message_text(f"بازی شروع شد! حکم: {HOKM_SUIT_EMOJIS[game['hokm_suit']]}\n\nنوبت {turn_player_name} است.", reply_markup=reply_markup)
 
-        # --- دست تکمیل شده، برنده را مشخص کن ---
-        trick_suit = game['current_trick'][0]['card'][0]
-        winner_play = max(game['current_trick'], key=lambda p: get_card_value(p['card'], game['hokm_suit'], trick_suit))
-        winner_id = winner_play['player_id']
-        
-        if game['mode'] == '4p':
-            winner_team = 'A' if winner_id in [game['players'][0]['id'], game['players'][2]['id']] else 'B'
-            game['trick_scores'][winner_team] += 1
-            round_over = game['trick_scores']['A'] == 7 or game['trick_scores']['B'] == 7
-        else:
-            game['trick_scores'][winner_id] += 1
-            round_over = any(score == 7 for score in game['trick_scores'].values())
+        elif action == "showhand":
+            if not any(p['id'] == user.id for p in game['players']):
+                await query.answer("شما بازیکن این مسابقه نیستید!", show_alert=True)
+                return
+            hand = game['hands'].get(user.id, b'')
+            hand_str = "\n".join([f"{NUMBER_EMOJIS[i]} {card_to_persian(c)}" for i, c in enumerate(hand)]) or "شما کارتی در دست ندارید."
+            await query.answer(f"دست شما:\n{hand_str}", show_alert=True)
 
-        game['turn_index'] = next(i for i, p in enumerate(game['players']) if p['id'] == winner_id)
+        elif action == "play":
+            if game['status'] != 'playing' or user.id != game['players'][game['turn_index']]['id']:
+                await query.answer("نوبت شما نیست!", show_alert=True)
+                return
         
-        # نمایش موقت نتیجه دست
-        winner_name = next(p['name'] for p in game['players'] if p['id'] == winner_id)
-        temp_game_state = game.copy()
-        temp_reply_markup = await render_hokm_board(temp_game_state, context)
-        await query.edit_message_text(f"برنده این دست: {winner_name}\n\nصبر کنید...", reply_markup=temp_reply_markup)
+            card_index = int(data[3])
+            hand = game['hands'][user.id]
+            if not (0 <= card_index < len(hand)):
+                await query.answer("شماره کارت نامعتبر است.", show_alert=True)
+                return
         
-        await asyncio.sleep(2.5)
-
-        game['current_trick'] = [] # پاک کردن میز
+            card_played = hand[card_index]
+            if game['current_trick']:
+                trick_suit = CARD_SUIT[game['current_trick'][0]['card']]
+                if CARD_SUIT[card_played] != trick_suit and any(CARD_SUIT[c] == trick_suit for c in hand):
+                    await query.answer(f"شما باید از خال زمین ({HOKM_SUIT_EMOJIS[trick_suit]}) بازی کنید!", show_alert=True)
+                    return
 
-        if not round_over:
-            turn_player_name = game['players'][game['turn_index']]['name']
-            reply_markup = await render_hokm_board(game, context)
-            await query.edit_message_text(f"حکم: {card_to_persian(game['hokm_suit']+'2')[0]}\n\nنوبت {turn_player_name} است.", reply_markup=reply_markup)
-        else:
-            # --- دور تمام شده، امتیاز را ثبت کن ---
-            if game['mode'] == '4p':
-                winning_team_name = 'A' if game['trick_scores']['A'] == 7 else 'B'
-                game['game_scores'][winning_team_name] += 1
-                winner_display_name = f"تیم {winning_team_name}"
-                game_over = game['game_scores'][winning_team_name] == 7
-            else:
-                round_winner_id = next(pid for pid, score in game['trick_scores'].items() if score == 7)
-                winner_display_name = next(p['name'] for p in game['players'] if p['id'] == round_winner_id)
-                game['game_scores'][round_winner_id] += 1
-                game_over = any(score == 7 for score in game['game_scores'].values())
+            del hand[card_index]
+            game['current_trick'].append({'player_id': user.id, 'card': card_played})
 
-            if game_over:
-                await query.edit_message_text(f"🏆 **بازی تمام شد!** 🏆\n\nبرنده نهایی: **{winner_display_name}**", parse_mode=ParseMode.MARKDOWN)
-                del active_games['hokm'][chat_id][game_id]
+            num_players = len(game['players'])
+            if len(game['current_trick']) < num_players:
+                game['turn_index'] = (game['turn_index'] + 1) % num_players
+                turn_player_name = game['players'][game['turn_index']]['name']
+                reply_markup = await render_hokm_board(game, context)
+                await query.edit_message_text(f"حکم: {HOKM_SUIT_EMOJIS[game['hokm_suit']]}\n\nنوبت {turn_player_name} است.", reply_markup=reply_markup)
                 return
-            
-            # --- شروع دور جدید ---
-            current_hakem_index = next(i for i, p in enumerate(game['players']) if p['id'] == game['hakem_id'])
+
+            # --- دست تکمیل شده، برنده را مشخص کن ---
+            card_values = CARD_VALUES[game['hokm_suit']][CARD_SUIT[game['current_trick'][0]['card']]]
+            winner_play = max(game['current_trick'], key=lambda p: card_values[p['card']])
+            winner_id = winner_play['player_id']
+        
             if game['mode'] == '4p':
-                hakem_team = 'A' if current_hakem_index in [0, 2] else 'B'
-                next_hakem_index = current_hakem_index if winning_team_name == hakem_team else (current_hakem_index + 1) % 4
+                winner_team = 'A' if winner_id in [game['players'][0]['id'], game['players'][2]['id']] else 'B'
+                game['trick_scores'][winner_team] += 1
             else:
-                round_winner_id = next(pid for pid, score in game['trick_scores'].items() if score == 7)
-                next_hakem_index = current_hakem_index if round_winner_id == game['hakem_id'] else (current_hakem_index + 1) % 2
-            
-            p_ids = [p['id'] for p in game['players']]
-            game.update({ 
-                "status": "dealing_first_5", "deck": create_deck(), 
-                "hands": {pid: [] for pid in p_ids},
-                "trick_scores": {'A': 0, 'B': 0} if game['mode'] == '4p' else {pid: 0 for pid in p_ids} 
-            })
-            for _ in range(5):
-                for p in game['players']: game['hands'][p['id']].append(game['deck'].pop(0))
-            
-            game['hakem_id'] = game['players'][next_hakem_index]['id']
-            game['hakem_name'] = game['players'][next_hakem_index]['name']
-            game['status'] = 'hakem_choosing'
-            game['turn_index'] = next_hakem_index
-
-            reply_markup = await render_hokm_board(game, context)
-            await query.edit_message_text(f"این دست تمام شد! برنده: {winner_display_name}\n\n-- دور جدید --\nحاکم جدید: {game['hakem_name']}\nمنتظر انتخاب حکم...", reply_markup=reply_markup)
+                game['trick_scores'][winner_id] += 1
 
-    elif action == "noop":
-        # این دکمه‌ها کاری انجام نمی‌دهند، پس فقط answer می‌دهیم
-        pass
+            game['turn_index'] = next(i for i, p in enumerate(game['players']) if p['id'] == winner_id)
+        
+            # نمایش موقت نتیجه دست؛ پاک کردن میز و ادامه بازی بعد از چند ثانیه توسط JobQueue انجام می‌شود
+            # تا هندلر منتظر نماند و آپدیت‌های دیگر معطل نشوند
+            winner_name = next(p['name'] for p in game['players'] if p['id'] == winner_id)
+            game['status'] = 'showing_trick'
+            context.job_queue.run_once(hokm_clear_trick_job, HOKM_TRICK_REVEAL_DELAY, chat_id=chat_id, data=game_id)
+            temp_reply_markup = await render_hokm_board(game, context)
+            await query.edit_message_text(f"برنده این دست: {winner_name}\n\nصبر کنید...", reply_markup=temp_reply_markup)
+
+        elif action == "noop":
+            # این دکمه‌ها کاری انجام نمی‌دهند، پس فقط answer می‌دهیم
+            pass
 # --------------------------- GAME: 2048 (جدید) ---------------------------
-# --- توابع کمکی 2048 (بدون تغییر در منطق) ---
+# --- موتور بیت‌بورد 2048 ---
+# کل صفحه یک عدد ۶۴ بیتی است: هر خانه ۴ بیت و مقدار آن توان ۲ مهره است (۰ = خالی).
+# سطر r در بیت‌های 16*r تا 16*r+15 و ستون c در نیبل c همان سطر قرار دارد.
+# حرکت چپ/راست هر سطر از جدول‌های از پیش محاسبه شده خوانده می‌شود و بالا/پایین با ترانهاده صفحه انجام می‌شود.
+WIN_2048_EXPONENT = 11 # 2**11 = 2048
+
+def _reverse_2048_row(row):
+    return ((row & 0xF) << 12) | ((row & 0xF0) << 4) | ((row >> 4) & 0xF0) | (row >> 12)
+
+def _build_2048_row_tables():
+    """جدول‌های حرکت چپ، حرکت راست، امتیاز حرکت و بزرگ‌ترین مهره را برای همه ۶۵۵۳۶ سطر ممکن می‌سازد."""
+    row_left = array('H', bytes(2 * 65536))
+    row_right = array('H', bytes(2 * 65536))
+    row_score = array('I', bytes(4 * 65536))
+    row_max = array('B', bytes(65536))
+    for row in range(65536):
+        cells = [(row >> (4 * c)) & 0xF for c in range(4)]
+        row_max[row] = max(cells)
+        tiles = [e for e in cells if e]
+        merged, score, i = [], 0, 0
+        while i < len(tiles):
+            if i + 1 < len(tiles) and tiles[i] == tiles[i + 1]:
+                exponent = min(tiles[i] + 1, 15)
+                merged.append(exponent)
+                score += 1 << exponent
+                i += 2
+            else:
+                merged.append(tiles[i])
+                i += 1
+        merged.extend([0] * (4 - len(merged)))
+        row_left[row] = merged[0] | merged[1] << 4 | merged[2] << 8 | merged[3] << 12
+        # امتیاز حرکت به چپ و راست برابر است (هر دنباله k تایی از مهره‌های برابر، k//2 ادغام دارد)
+        row_score[row] = score
+    # حرکت راست یک سطر، وارونه حرکت چپِ سطر وارونه است
+    for row in range(65536):
+        row_right[row] = _reverse_2048_row(row_left[_reverse_2048_row(row)])
+    return row_left, row_right, row_score, row_max
+
+_ROW_LEFT, _ROW_RIGHT, _ROW_SCORE, _ROW_MAX = _build_2048_row_tables()
+
+def transpose_2048_board(board):
+    """ترانهاده صفحه ۴x۴ با عملیات بیتی (سطرها به ستون‌ها)."""
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
 
 def new_2048_board():
     """یک صفحه خالی ۴x۴ برای بازی 2048 ایجاد می‌کند."""
-    return [[0] * 4 for _ in range(4)]
+    return 0
+
+def get_2048_cell(board, r, c):
+    """مقدار مهره خانه (r, c) را برمی‌گرداند (۰ برای خانه خالی)."""
+    exponent = (board >> (16 * r + 4 * c)) & 0xF
+    return 1 << exponent if exponent else 0
 
 def add_new_2048_tile(board):
-    """یک مهره ۲ یا ۴ به صورت تصادفی به یک خانه خالی اضافه می‌کند."""
-    empty_cells = [(r, c) for r in range(4) for c in range(4) if board[r][c] == 0]
-    if not empty_cells:
+    """یک مهره ۲ یا ۴ به صورت تصادفی به یک خانه خالی اضافه می‌کند و صفحه جدید را برمی‌گرداند."""
+    empty_shifts = [shift for shift in range(0, 64, 4) if not (board >> shift) & 0xF]
+    if not empty_shifts:
         return board
-    r, c = random.choice(empty_cells)
-    board[r][c] = 2 if random.random() < 0.9 else 4  # 90% شانس برای ۲
-    return board
+    exponent = 1 if random.random() < 0.9 else 2  # 90% شانس برای ۲
+    return board | (exponent << random.choice(empty_shifts))
+
+def _apply_2048_row_table(board, table):
+    return (table[board & 0xFFFF]
+            | table[(board >> 16) & 0xFFFF] << 16
+            | table[(board >> 32) & 0xFFFF] << 32
+            | table[(board >> 48) & 0xFFFF] << 48)
+
+def _row_table_score(board):
+    return (_ROW_SCORE[board & 0xFFFF] + _ROW_SCORE[(board >> 16) & 0xFFFF]
+            + _ROW_SCORE[(board >> 32) & 0xFFFF] + _ROW_SCORE[(board >> 48) & 0xFFFF])
+
+def move_2048(board, direction):
+    """حرکت را اعمال می‌کند و (صفحه جدید، امتیاز کسب شده، آیا حرکت انجام شد) را برمی‌گرداند."""
+    table = _ROW_LEFT if direction in ('left', 'up') else _ROW_RIGHT
+    if direction in ('left', 'right'):
+        new_board = _apply_2048_row_table(board, table)
+        score = _row_table_score(board)
+    else:
+        transposed = transpose_2048_board(board)
+        new_board = transpose_2048_board(_apply_2048_row_table(transposed, table))
+        score = _row_table_score(transposed)
+    return new_board, score, new_board != board
 
 def can_move_2048(board):
     """بررسی می‌کند آیا حرکتی در صفحه امکان‌پذیر است یا خیر."""
-    for r in range(4):
-        for c in range(4):
-            if board[r][c] == 0:
-                return True  # خانه خالی وجود دارد
-            # چک کردن همسایه‌های سمت راست و پایین
-            if c < 3 and board[r][c] == board[r][c+1]:
-                return True
-            if r < 3 and board[r][c] == board[r+1][c]:
-                return True
+    transposed = transpose_2048_board(board)
+    for b in (board, transposed):
+        if _apply_2048_row_table(b, _ROW_LEFT) != b or _apply_2048_row_table(b, _ROW_RIGHT) != b:
+            return True
     return False
 
-def transform_2048_board(board, direction):
-    """صفحه را بر اساس جهت حرکت می‌چرخاند تا منطق حرکت به چپ برای همه جهات قابل استفاده باشد."""
-    if direction == 'left':
-        return board
-    if direction == 'right':
-        return [row[::-1] for row in board]
-    if direction == 'up':
-        return [list(col) for col in zip(*board)]  # Transpose
-    if direction == 'down':
-        new_board = [list(col) for col in zip(*board)]  # Transpose
-        return [row[::-1] for row in new_board]
-
-def reverse_transform_2048_board(board, direction):
-    """صفحه چرخانده شده را به حالت اولیه برمی‌گرداند."""
-    if direction == 'left':
-        return board
-    if direction == 'right':
-        return [row[::-1] for row in board]
-    if direction == 'up':
-        return [list(col) for col in zip(*board)]  # Transpose
-    if direction == 'down':
-        board = [row[::-1] for row in board]
-        return [list(col) for col in zip(*board)]  # Transpose
-
-def move_2048_left(board):
-    """منطق اصلی حرکت و ادغام مهره‌ها به سمت چپ."""
-    new_board = []
-    score_increment = 0
-    moved = False
-    for row in board:
-        compressed_row = [num for num in row if num != 0]
-        new_row = []
-        i = 0
-        while i < len(compressed_row):
-            if i + 1 < len(compressed_row) and compressed_row[i] == compressed_row[i+1]:
-                new_value = compressed_row[i] * 2
-                new_row.append(new_value)
-                score_increment += new_value
-                i += 2
-            else:
-                new_row.append(compressed_row[i])
-                i += 1
-        new_row.extend([0] * (4 - len(new_row)))
-        new_board.append(new_row)
-    
-    if board != new_board:
-        moved = True
-        
-    return new_board, score_increment, moved
+def max_2048_exponent(board):
+    """توان بزرگ‌ترین مهره صفحه."""
+    return max(_ROW_MAX[board & 0xFFFF], _ROW_MAX[(board >> 16) & 0xFFFF],
+               _ROW_MAX[(board >> 32) & 0xFFFF], _ROW_MAX[(board >> 48) & 0xFFFF])
 
 async def render_2048_board(game):
     """صفحه بازی 2048 را برای نمایش به کاربر رندر می‌کند."""
@@ -1658,7 +2602,8 @@ async def render_2048_board(game):
     
     keyboard = []
     for r in range(4):
-        row_buttons = [InlineKeyboardButton(tile_map.get(cell, str(cell)), callback_data=f"2048_noop_{game_id}") for cell in board[r]]
+        cells = (get_2048_cell(board, r, c) for c in range(4))
+        row_buttons = [InlineKeyboardButton(tile_map.get(cell, str(cell)), callback_data=f"2048_noop_{game_id}") for cell in cells]
         keyboard.append(row_buttons)
         
     keyboard.extend([
@@ -1684,12 +2629,11 @@ async def render_2048_board(game):
 
 # --- تابع اصلی و اصلاح شده 2048 ---
 
-async def game_2048_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def game_2048_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
-    data = query.data.split('_')
     action = data[1]
 
     if action == "start":
@@ -1715,16 +2659,13 @@ async def game_2048_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         sent_message = await query.message.reply_text("در حال ساخت بازی 2048...")
         game_id = sent_message.message_id
         
-        initial_board = new_2048_board()
-        add_new_2048_tile(initial_board)
-        add_new_2048_tile(initial_board)
+        initial_board = add_new_2048_tile(add_new_2048_tile(new_2048_board()))
         
         game = {
             "game_id": game_id,
             "player_id": user.id,
             "board": initial_board,
-            "score": 0,
-            "is_busy": False
+            "score": 0
         }
         active_games['2048'][chat_id][game_id] = game
         
@@ -1743,42 +2684,33 @@ async def game_2048_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer("خطا در پردازش درخواست.", show_alert=True)
         return
 
-    if chat_id not in active_games['2048'] or game_id not in active_games['2048'][chat_id]:
-        await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
-        return
-        
-    game = active_games['2048'][chat_id][game_id]
-    
-    if user.id != game['player_id']:
-        await query.answer("این بازی برای شما نیست!", show_alert=True)
-        return
-
-    if game.get('is_busy', False):
-        await query.answer("کمی صبر کنید...")
-        return
-    
-    await query.answer()
+    async with get_game_lock('2048', chat_id, game_id):
+        game = active_games['2048'].get(chat_id, {}).get(game_id)
+        if not game:
+            await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
+            return
+        if user.id != game['player_id']:
+            await query.answer("این بازی برای شما نیست!", show_alert=True)
+            return
+        touch_game(game)
 
-    if action == "move":
-        game['is_busy'] = True
-        try:
+        if action == "move":
             direction = data[3]
             
-            transformed = transform_2048_board(game['board'], direction)
-            moved_board, score_inc, moved = move_2048_left(transformed)
-            final_board = reverse_transform_2048_board(moved_board, direction)
+            final_board, score_inc, moved = move_2048(game['board'], direction)
 
-            if moved:
-                game['board'] = add_new_2048_tile(final_board)
-                game['score'] += score_inc
-            else:
+            if not moved:
                 await query.answer("حرکت غیرمجاز!")
                 return
 
+            await query.answer()
+            game['board'] = add_new_2048_tile(final_board)
+            game['score'] += score_inc
+
             text, reply_markup = await render_2048_board(game)
             
             game_over = False
-            if any(2048 in row for row in game['board']):
+            if max_2048_exponent(game['board']) >= WIN_2048_EXPONENT:
                 text += f"\n\n🏆 **تبریک!** شما برنده شدید! 🏆"
                 game_over = True
             elif not can_move_2048(game['board']):
@@ -1786,20 +2718,18 @@ async def game_2048_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 game_over = True
 
             if game_over:
-                await query.edit_message_text(text, reply_markup=None, parse_mode=ParseMode.MARKDOWN)
                 del active_games['2048'][chat_id][game_id]
+                await query.edit_message_text(text, reply_markup=None, parse_mode=ParseMode.MARKDOWN)
             else:
                 await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        finally:
-            if chat_id in active_games['2048'] and game_id in active_games['2048'][chat_id]:
-                active_games['2048'][chat_id][game_id]['is_busy'] = False
 
-    elif action == "close":
-        await query.edit_message_text("بازی 2048 بسته شد.")
-        del active_games['2048'][chat_id][game_id]
+        elif action == "close":
+            await query.answer()
+            del active_games['2048'][chat_id][game_id]
+            await query.edit_message_text("بازی 2048 بسته شد.")
 
-    elif action == "noop":
-        pass
+        elif action == "noop":
+            await query.answer()
 # --------------------------- GAME: GUESS THE NUMBER (ConversationHandler - بدون تغییر) ---------------------------
 async def hads_addad_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
@@ -1856,6 +2786,7 @@ async def handle_guess_conversation(update: Update, context: ContextTypes.DEFAUL
     chat_id = update.effective_chat.id
     if chat_id not in active_games['guess_number']: return ConversationHandler.END
     guess = int(convert_persian_to_english_numbers(update.message.text))
+    touch_game(active_games['guess_number'][chat_id])
     secret_number = active_games['guess_number'][chat_id]['number']
     user = update.effective_user
     if guess < secret_number: await update.message.reply_text("بالاتر ⬆️")
@@ -1873,15 +2804,33 @@ async def cancel_game_conversation(update: Update, context: ContextTypes.DEFAULT
     await rsgame_command(update, context)
     return ConversationHandler.END
 
+# --------------------------- تشخیص خط (مشترک بین دوز، Connect Four و دوز ۴ نفره) ---------------------------
+# فقط چهار خط گذرنده از آخرین مهره بررسی می‌شود؛ هزینه هر حرکت به اندازه صفحه بستگی ندارد.
+LINE_DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1)) # افقی، عمودی، مورب اصلی، مورب فرعی
+
+def completes_line(board, r, c, length):
+    """بررسی می‌کند آیا مهره تازه گذاشته شده در خانه (r, c) یک خط length تایی از همان مهره ساخته است."""
+    symbol = board[r][c]
+    rows, cols = len(board), len(board[0])
+    for dr, dc in LINE_DIRECTIONS:
+        count = 1
+        for step_r, step_c in ((dr, dc), (-dr, -dc)):
+            rr, cc = r + step_r, c + step_c
+            while count < length and 0 <= rr < rows and 0 <= cc < cols and board[rr][cc] == symbol:
+                count += 1
+                rr, cc = rr + step_r, cc + step_c
+        if count >= length:
+            return True
+    return False
+
 # --------------------------- GAME: DOOZ (TIC-TAC-TOE) - ##### بازنویسی کامل ##### ---------------------------
-async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat_id
 
     # if await check_ban_status(update, context): return
 
-    data = query.data.split('_')
     action = data[1]
 
     # --- بلوک ۱: شروع بازی ---
@@ -1906,6 +2855,7 @@ async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "status": "joining",
             "players_info": [{'id': user.id, 'name': user.first_name, 'symbol': '❌'}],
             "board": [[" "]*3 for _ in range(3)],
+            "moves": 0, # تعداد خانه‌های پر شده، برای تشخیص مساوی
             "turn": None
         }
         active_games['dooz'][chat_id][game_id] = game
@@ -1936,6 +2886,8 @@ async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     game = active_games['dooz'][chat_id][game_id]
+    if is_game_participant(game, user.id):
+        touch_game(game)
 
     # --- ساختار جدید با elif ---
     if action == "join":
@@ -1950,6 +2902,7 @@ async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             await query.answer()
         game['players_info'].append({'id': user.id, 'name': user.first_name, 'symbol': '⭕️'})
+        touch_game(game)
         game['status'] = 'playing'
         game['turn'] = game['players_info'][0]['id'] # نوبت با بازیکن اول
 
@@ -1991,15 +2944,13 @@ async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         current_player = next(p for p in game['players_info'] if p['id'] == user.id)
         symbol = current_player['symbol']
         game['board'][row][col] = symbol
+        game['moves'] += 1
         
         # بررسی وضعیت برد
         b = game['board']
-        win = any(all(c==symbol for c in r) for r in b) or \
-              any(all(b[r][c]==symbol for r in range(3)) for c in range(3)) or \
-              all(b[i][i]==symbol for i in range(3)) or \
-              all(b[i][2-i]==symbol for i in range(3))
+        win = completes_line(b, row, col, 3)
         
-        is_draw = all(c!=" " for r in b for c in r) and not win
+        is_draw = game['moves'] == 9 and not win
         
         # ساخت کیبورد جدید بر اساس وضعیت فعلی صفحه
         board_rows = [
@@ -2034,31 +2985,32 @@ async def dooz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("این بازی تمام شده است.", show_alert=True)
 
 # --------------------------- GAME: CONNECT FOUR (جدید) --------------------------
-# --- توابع کمکی Connect Four (منطق اصلی بدون تغییر) ---
-
-def check_connect4_winner(board, symbol):
-    """بررسی می‌کند که آیا بازیکن با مهره 'symbol' برنده شده است یا خیر."""
-    ROWS, COLS = 6, 7
-    # بررسی افقی
-    for r in range(ROWS):
-        for c in range(COLS - 3):
-            if all(board[r][c+i] == symbol for i in range(4)):
-                return True
-    # بررسی عمودی
-    for r in range(ROWS - 3):
-        for c in range(COLS):
-            if all(board[r+i][c] == symbol for i in range(4)):
-                return True
-    # بررسی مورب (پایین به بالا)
-    for r in range(3, ROWS):
-        for c in range(COLS - 3):
-            if all(board[r-i][c+i] == symbol for i in range(4)):
-                return True
-    # بررسی مورب (بالا به پایین)
-    for r in range(ROWS - 3):
-        for c in range(COLS - 3):
-            if all(board[r+i][c+i] == symbol for i in range(4)):
-                return True
+# --- بیت‌بورد Connect Four ---
+# هر بازیکن یک عدد ۴۹ بیتی دارد: ستون c در بیت‌های 7*c تا 7*c+6 و بیت 7*c+h خانه ارتفاع h (۰ = پایین) است.
+# بیت هفتم هر ستون همیشه خالی می‌ماند تا شیفت‌ها از یک ستون به ستون بعد سرریز نکنند.
+CONNECT4_ROWS, CONNECT4_COLS = 6, 7
+CONNECT4_COLUMN_BITS = CONNECT4_ROWS + 1
+CONNECT4_EMPTY = '⚪️'
+
+def new_connect4_state():
+    """بیت‌بورد دو بازیکن و ارتفاع فعلی هر ستون."""
+    return {"bitboards": [0, 0], "heights": [0] * CONNECT4_COLS}
+
+def connect4_drop(game, col, player_index):
+    """مهره بازیکن را در ستون col می‌اندازد؛ اگر ستون پر باشد False برمی‌گرداند."""
+    height = game['heights'][col]
+    if height >= CONNECT4_ROWS:
+        return False
+    game['bitboards'][player_index] |= 1 << (col * CONNECT4_COLUMN_BITS + height)
+    game['heights'][col] = height + 1
+    return True
+
+def connect4_has_four(bitboard):
+    """بررسی چهار مهره پشت سر هم با شیفت و ماسک (عمودی، افقی و دو قطر)."""
+    for shift in (1, CONNECT4_COLUMN_BITS, CONNECT4_COLUMN_BITS - 1, CONNECT4_COLUMN_BITS + 1):
+        pairs = bitboard & (bitboard >> shift)
+        if pairs & (pairs >> (2 * shift)):
+            return True
     return False
 
 # --- تابع رندر بهینه‌سازی شده ---
@@ -2066,7 +3018,8 @@ def check_connect4_winner(board, symbol):
 def render_connect4_board(game: dict, is_finished: bool = False):
     """صفحه بازی را به همراه متن و دکمه‌ها تولید می‌کند."""
     game_id = game['game_id']
-    board = game['board']
+    symbols = [p['symbol'] for p in game['players_info']]
+    bitboards = game['bitboards']
     
     # تعیین متن پیام بر اساس وضعیت بازی
     if is_finished:
@@ -2081,13 +3034,16 @@ def render_connect4_board(game: dict, is_finished: bool = False):
         text = f"بازی چهار در یک ردیف\n{p1['name']} ({p1['symbol']}) ⚔️ {p2['name']} ({p2['symbol']})\n\nنوبت {turn_player['name']} است."
 
     # ساخت کیبورد
+    # اگر بازی تمام شده باشد، دکمه‌ها غیرفعال می‌شوند
+    callback_action = "noop" if is_finished else "move"
     keyboard = []
-    for r in range(len(board)):
+    for r in range(CONNECT4_ROWS):
+        height = CONNECT4_ROWS - 1 - r # سطر بالای صفحه بیشترین ارتفاع را دارد
         row_buttons = []
-        for c in range(len(board[0])):
-            # اگر بازی تمام شده باشد، دکمه‌ها غیرفعال می‌شوند
-            callback_action = "noop" if is_finished else "move"
-            row_buttons.append(InlineKeyboardButton(board[r][c], callback_data=f"connect4_{callback_action}_{game_id}_{c}"))
+        for c in range(CONNECT4_COLS):
+            bit = 1 << (c * CONNECT4_COLUMN_BITS + height)
+            cell = next((symbol for symbol, bitboard in zip(symbols, bitboards) if bitboard & bit), CONNECT4_EMPTY)
+            row_buttons.append(InlineKeyboardButton(cell, callback_data=f"connect4_{callback_action}_{game_id}_{c}"))
         keyboard.append(row_buttons)
     
     return text, InlineKeyboardMarkup(keyboard)
@@ -2095,14 +3051,13 @@ def render_connect4_board(game: dict, is_finished: bool = False):
 
 # --- تابع اصلی و اصلاح شده Connect Four ---
 
-async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
     # if await check_ban_status(update, context): return
     
-    data = query.data.split('_')
     action = data[1]
 
     # --- بلوک ۱: شروع بازی ---
@@ -2126,7 +3081,8 @@ async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "game_id": game_id,
             "status": "joining",
             "players_info": [{'id': user.id, 'name': user.first_name, 'symbol': '🔴'}],
-            "board": [['⚪️']*7 for _ in range(6)],
+            **new_connect4_state(),
+            "moves": 0,
             "turn": None
         }
         active_games['connect4'][chat_id][game_id] = game
@@ -2157,6 +3113,8 @@ async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     game = active_games['connect4'][chat_id][game_id]
+    if is_game_participant(game, user.id):
+        touch_game(game)
 
     if action == "join":
         if not await check_join_for_alert(update, context): return
@@ -2170,6 +3128,7 @@ async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             await query.answer()
         game['players_info'].append({'id': user.id, 'name': user.first_name, 'symbol': '🟡'})
+        touch_game(game)
         game['status'] = 'playing'
         game['turn'] = game['players_info'][0]['id']
 
@@ -2190,25 +3149,18 @@ async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         col_index = int(data[3])
+        player_index = next(i for i, p in enumerate(game['players_info']) if p['id'] == user.id)
         
-        # پیدا کردن پایین‌ترین خانه خالی در ستون
-        row_index = -1
-        for r in range(5, -1, -1):
-            if game['board'][r][col_index] == '⚪️':
-                row_index = r
-                break
-        
-        if row_index == -1:
+        if not connect4_drop(game, col_index, player_index):
             await query.answer("این ستون پر است!", show_alert=True)
             return
             
-        current_player = next(p for p in game['players_info'] if p['id'] == user.id)
-        symbol = current_player['symbol']
-        game['board'][row_index][col_index] = symbol
+        current_player = game['players_info'][player_index]
+        game['moves'] += 1
 
         # بررسی برنده یا مساوی
-        is_winner = check_connect4_winner(game['board'], symbol)
-        is_draw = all(cell != '⚪️' for row in game['board'] for cell in row) and not is_winner
+        is_winner = connect4_has_four(game['bitboards'][player_index])
+        is_draw = game['moves'] == CONNECT4_ROWS * CONNECT4_COLS and not is_winner
 
         if is_winner or is_draw:
             game['status'] = 'finished'
@@ -2234,14 +3186,13 @@ async def connect4_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --------------------------- GAME: ROCK, PAPER, SCISSORS (جدید) ---------------------------
 
-async def rps_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rps_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
     # if await check_ban_status(update, context): return
     
-    data = query.data.split('_')
     action = data[1]
 
     # --- بلوک ۱: شروع بازی ---
@@ -2290,6 +3241,8 @@ async def rps_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     game = active_games['rps'][chat_id][game_id]
+    if is_game_participant(game, user.id):
+        touch_game(game)
 
     if action == "join":
         if not await check_join_for_alert(update, context): return
@@ -2303,6 +3256,7 @@ async def rps_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             await query.answer()
         game['players_info'].append({'id': user.id, 'name': user.first_name})
+        touch_game(game)
         game['status'] = 'playing'
         
         p1_name = game['players_info'][0]['name']
@@ -2390,6 +3344,8 @@ MEMORY_EMOJIS = [
     "⚽", "🏀", "🎳", "🎸", "🎮", "🎯", "🎨", "🚀", "🚁", "🎁", "🎈", "💎", "👑", "❤️", "🧡", "💙", "💚", "💜"
 ]
 
+MEMORY_REVEAL_DELAY = 1.5 # مدت نمایش دو کارت برگردانده شده قبل از بررسی جفت (ثانیه)
+
 # --- توابع کمکی (منطق بدون تغییر) ---
 def generate_memory_board(rows, cols):
     """یک لیست درهم‌ریخته از جفت ایموجی‌ها برای صفحه بازی تولید می‌کند."""
@@ -2438,13 +3394,67 @@ async def render_memory_board(game: dict, is_finished: bool = False):
         
     return text, InlineKeyboardMarkup(keyboard)
 
+async def memory_check_pair_job(context: ContextTypes.DEFAULT_TYPE):
+    """دو کارت برگردانده شده را بعد از مکث نمایشی بررسی می‌کند (توسط JobQueue اجرا می‌شود)."""
+    try:
+        await _memory_check_pair(context)
+    finally:
+        # تغییرات بعد از touch_game (پس از await ها) هم باید ذخیره شوند
+        mark_chat_dirty(context.job.chat_id)
+
+async def _memory_check_pair(context: ContextTypes.DEFAULT_TYPE):
+    chat_id, game_id = context.job.chat_id, context.job.data
+    async with get_game_lock('memory', chat_id, game_id):
+        game = active_games['memory'].get(chat_id, {}).get(game_id)
+        if not game or not game.get('second_card'):
+            return
+        touch_game(game)
+
+        try:
+            first_card, second_card = game['first_card'], game['second_card']
+            r, c = second_card['r'], second_card['c']
+        
+            if second_card['val'] == first_card['val'] and (r, c) != (first_card['r'], first_card['c']):
+                game['matched_pairs'] += 1
+                current_player = next(p for p in game['players_info'] if p['id'] == game['turn'])
+                current_player['score'] += 1
+            else:
+                game['board_view'][r][c] = '❔'
+                game['board_view'][first_card['r']][first_card['c']] = '❔'
+                current_turn_id = game['turn']
+                next_player = next(p for p in game['players_info'] if p['id'] != current_turn_id)
+                game['turn'] = next_player['id']
+        finally:
+            game['first_card'] = None
+            game['second_card'] = None
+
+        if game['matched_pairs'] == game['total_pairs']:
+            p1 = game['players_info'][0]
+            p2 = game['players_info'][1]
+        
+            if p1['score'] > p2['score']: winner = p1
+            elif p2['score'] > p1['score']: winner = p2
+            else: winner = None
+        
+            text, reply_markup = await render_memory_board(game, is_finished=True)
+        
+            if winner:
+                text += f"\n\n🏆 **برنده نهایی: {winner['name']}**"
+            else:
+                text += "\n\n🤝 بازی **مساوی** شد!"
+        
+            del active_games['memory'][chat_id][game_id]
+            await context.bot.edit_message_text(text, chat_id=chat_id, message_id=game_id, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+        else:
+            text, reply_markup = await render_memory_board(game)
+            await context.bot.edit_message_text(text, chat_id=chat_id, message_id=game_id, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
 # --- تابع اصلی و بازنویسی شده ---
-async def memory_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def memory_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
-    data = query.data.split('_')
     action = data[1]
 
     if action == "start":
@@ -2474,7 +3484,7 @@ async def memory_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "board_view": [['❔'] * cols for _ in range(rows)],
             "turn": None,
             "first_card": None,
-            "is_checking": False,
+            "second_card": None,
             "matched_pairs": 0,
             "total_pairs": (rows * cols) // 2
         }
@@ -2496,155 +3506,159 @@ async def memory_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("خطای دکمه.", show_alert=True)
         return
 
-    if chat_id not in active_games['memory'] or game_id not in active_games['memory'][chat_id]:
-        await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
+    if action == "join" and not await check_join_for_alert(update, context):
         return
-        
-    game = active_games['memory'][chat_id][game_id]
 
-    if action == "join":
-        if not await check_join_for_alert(update, context):
+    async with get_game_lock('memory', chat_id, game_id):
+        game = active_games['memory'].get(chat_id, {}).get(game_id)
+        if not game:
+            await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
             return
+        if is_game_participant(game, user.id):
+            touch_game(game)
 
-        await query.answer()
-        if any(p['id'] == user.id for p in game['players_info']):
-            await query.answer("شما قبلاً به بازی پیوسته‌اید!", show_alert=True)
-            return
-        if len(game['players_info']) >= 2:
-            await query.answer("ظرفیت بازی تکمیل است.", show_alert=True)
-            return
+        if action == "join":
+            if any(p['id'] == user.id for p in game['players_info']):
+                await query.answer("شما قبلاً به بازی پیوسته‌اید!", show_alert=True)
+                return
+            if len(game['players_info']) >= 2:
+                await query.answer("ظرفیت بازی تکمیل است.", show_alert=True)
+                return
             
-        game['players_info'].append({'id': user.id, 'name': user.first_name, 'score': 0})
-        game['status'] = 'playing'
-        game['turn'] = game['players_info'][0]['id']
-
-        text, reply_markup = await render_memory_board(game)
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        return
-
-    elif action == "flip":
-        if game.get('is_checking', False):
-            await query.answer("لطفاً صبر کنید...", show_alert=False)
-            return
-        
-        if user.id != game.get('turn'):
-            await query.answer("نوبت شما نیست!", show_alert=True)
-            return
-        
-        r, c = int(data[3]), int(data[4])
-        
-        if game['board_view'][r][c] != '❔':
-            await query.answer("این کارت قبلاً انتخاب شده!", show_alert=True)
-            return
-        
-        await query.answer()
-        card_value = game['board_solution'][r][c]
-        game['board_view'][r][c] = card_value
+            await query.answer()
+            game['players_info'].append({'id': user.id, 'name': user.first_name, 'score': 0})
+            touch_game(game)
+            game['status'] = 'playing'
+            game['turn'] = game['players_info'][0]['id']
 
-        if not game['first_card']:
-            game['first_card'] = {'r': r, 'c': c, 'val': card_value}
             text, reply_markup = await render_memory_board(game)
             await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-        else:
-            game['is_checking'] = True
-            try:
-                text, reply_markup = await render_memory_board(game)
-                await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-                await asyncio.sleep(1.5)
-                
-                first_card = game['first_card']
-                
-                if card_value == first_card['val'] and (r, c) != (first_card['r'], first_card['c']):
-                    game['matched_pairs'] += 1
-                    current_player = next(p for p in game['players_info'] if p['id'] == game['turn'])
-                    current_player['score'] += 1
-                else:
-                    game['board_view'][r][c] = '❔'
-                    game['board_view'][first_card['r']][first_card['c']] = '❔'
-                    current_turn_id = game['turn']
-                    next_player = next(p for p in game['players_info'] if p['id'] != current_turn_id)
-                    game['turn'] = next_player['id']
-            finally:
-                game['first_card'] = None
-                game['is_checking'] = False
-
-            if game['matched_pairs'] == game['total_pairs']:
-                p1 = game['players_info'][0]
-                p2 = game['players_info'][1]
-                
-                if p1['score'] > p2['score']: winner = p1
-                elif p2['score'] > p1['score']: winner = p2
-                else: winner = None
-                
-                text, reply_markup = await render_memory_board(game, is_finished=True)
-                
-                if winner:
-                    text += f"\n\n🏆 **برنده نهایی: {winner['name']}**"
-                else:
-                    text += "\n\n🤝 بازی **مساوی** شد!"
-                
-                await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-                if chat_id in active_games['memory']:
-                    del active_games['memory'][chat_id][game_id]
-            else:
-                text, reply_markup = await render_memory_board(game)
-                await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-    
-    elif action == "noop":
-        await query.answer("این بازی تمام شده است.", show_alert=True)
-
-# =========================== SAMEGAME CODE (START) ==========================
-# --- توابع کمکی SameGame ---
+            return
 
-def create_samegame_board():
-    """یک صفحه بازی تصادفی برای بازی جفت‌ها ایجاد می‌کند."""
-    return [[random.choice(SAMEGAME_COLORS) for _ in range(SAMEGAME_WIDTH)] for _ in range(SAMEGAME_HEIGHT)]
+        elif action == "flip":
+            # تا زمانی که جفت کارت قبلی بررسی نشده، کارت جدیدی برگردانده نمی‌شود
+            if game.get('second_card'):
+                await query.answer("لطفاً صبر کنید...", show_alert=False)
+                return
+            
+            if user.id != game.get('turn'):
+                await query.answer("نوبت شما نیست!", show_alert=True)
+                return
+            
+            r, c = int(data[3]), int(data[4])
+            
+            if game['board_view'][r][c] != '❔':
+                await query.answer("این کارت قبلاً انتخاب شده!", show_alert=True)
+                return
+            
+            await query.answer()
+            card_value = game['board_solution'][r][c]
+            game['board_view'][r][c] = card_value
 
-def find_samegame_group(board, r_start, c_start):
-    """تمام بلوک‌های همرنگ و متصل را پیدا می‌کند."""
-    target_color = board[r_start][c_start]
-    if target_color == EMPTY_CELL:
-        return []
+            if not game['first_card']:
+                game['first_card'] = {'r': r, 'c': c, 'val': card_value}
+            else:
+                # کارت دوم چند لحظه نمایش داده می‌شود و بررسی جفت توسط JobQueue انجام می‌شود
+                game['second_card'] = {'r': r, 'c': c, 'val': card_value}
+                context.job_queue.run_once(memory_check_pair_job, MEMORY_REVEAL_DELAY, chat_id=chat_id, data=game_id)
 
-    q = [(r_start, c_start)]
-    group = set(q)
+            text, reply_markup = await render_memory_board(game)
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     
-    while q:
-        r, c = q.pop(0)
-        for dr, dc in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-            nr, nc = r + dr, c + dc
-            if (0 <= nr < SAMEGAME_HEIGHT and 0 <= nc < SAMEGAME_WIDTH and
-                    board[nr][nc] == target_color and (nr, nc) not in group):
-                group.add((nr, nc))
-                q.append((nr, nc))
-    return list(group)
+        elif action == "noop":
+            await query.answer("این بازی تمام شده است.", show_alert=True)
 
-# --- تابع بازنویسی شده برای پر کردن تصادفی ---
-def refill_samegame_board_randomly(board):
-    """خانه‌های خالی را با بلوک‌های رنگی تصادفی جدید پر می‌کند."""
-    for r in range(SAMEGAME_HEIGHT):
-        for c in range(SAMEGAME_WIDTH):
-            if board[r][c] == EMPTY_CELL:
-                board[r][c] = random.choice(SAMEGAME_COLORS)
-    return board
+# =========================== SAMEGAME CODE (START) ==========================
+# --- موتور SameGame ---
+# صفحه یک bytearray با اندیس r * width + c است و مقدار هر خانه شماره رنگ (۱ تا تعداد رنگ‌ها) است.
+# گروه‌های همرنگ متصل با union-find برچسب‌گذاری می‌شوند. گروه انتخاب شده کامل حذف و با رنگ‌های تازه
+# پر می‌شود، پس هیچ گروه دیگری شکسته نمی‌شود و به‌روزرسانی برچسب‌ها فقط ادغام خانه‌های تازه است.
+# movable تعداد گروه‌های حداقل دو بلوکی است؛ صفر شدن آن یعنی حرکتی باقی نمانده.
+
+def _samegame_find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
+
+def _samegame_union(game, a, b):
+    parent, size = game['parent'], game['size']
+    root_a, root_b = _samegame_find(parent, a), _samegame_find(parent, b)
+    if root_a == root_b:
+        return
+    if size[root_a] < size[root_b]:
+        root_a, root_b = root_b, root_a
+    # گروه ادغام شده حتماً قابل حذف است؛ گروه‌های قابل حذف قبلی از شمارش کم می‌شوند
+    game['movable'] += 1 - (size[root_a] >= 2) - (size[root_b] >= 2)
+    parent[root_b] = root_a
+    size[root_a] += size[root_b]
+
+def _samegame_link(game, cells):
+    """خانه‌های داده شده را به همسایه‌های همرنگشان وصل می‌کند."""
+    board, width, height = game['board'], game['width'], game['height']
+    for idx in cells:
+        r, c = divmod(idx, width)
+        color = board[idx]
+        if c + 1 < width and board[idx + 1] == color:
+            _samegame_union(game, idx, idx + 1)
+        if c > 0 and board[idx - 1] == color:
+            _samegame_union(game, idx, idx - 1)
+        if r + 1 < height and board[idx + width] == color:
+            _samegame_union(game, idx, idx + width)
+        if r > 0 and board[idx - width] == color:
+            _samegame_union(game, idx, idx - width)
+
+def create_samegame_state(width=SAMEGAME_WIDTH, height=SAMEGAME_HEIGHT):
+    """یک صفحه تصادفی به همراه برچسب گروه‌ها و شمارنده حرکات باقی‌مانده ایجاد می‌کند."""
+    cells = width * height
+    state = {
+        "width": width, "height": height,
+        "board": bytearray(random.randint(1, len(SAMEGAME_COLORS)) for _ in range(cells)),
+        "parent": array('H', range(cells)),
+        "size": array('H', [1]) * cells,
+        "movable": 0,
+    }
+    _samegame_link(state, range(cells))
+    return state
+
+def find_samegame_group(game, r, c):
+    """اندیس تمام بلوک‌های همرنگ و متصل به خانه (r, c) را برمی‌گرداند."""
+    width = game['width']
+    start = r * width + c
+    if game['size'][_samegame_find(game['parent'], start)] < 2:
+        return [start]
+
+    board, height = game['board'], game['height']
+    color = board[start]
+    group = {start}
+    queue = deque(group)
+    while queue:
+        idx = queue.popleft()
+        r, c = divmod(idx, width)
+        for n_idx, valid in ((idx + 1, c + 1 < width), (idx - 1, c > 0), (idx + width, r + 1 < height), (idx - width, r > 0)):
+            if valid and n_idx not in group and board[n_idx] == color:
+                group.add(n_idx)
+                queue.append(n_idx)
+    return list(group)
 
-def is_game_over_samegame(board):
-    """بررسی می‌کند آیا حرکتی باقی مانده است یا خیر."""
-    for r in range(SAMEGAME_HEIGHT):
-        for c in range(SAMEGAME_WIDTH):
-            if board[r][c] != EMPTY_CELL:
-                if c + 1 < SAMEGAME_WIDTH and board[r][c] == board[r][c+1]:
-                    return False
-                if r + 1 < SAMEGAME_HEIGHT and board[r][c] == board[r+1][c]:
-                    return False
-    return True
+def remove_samegame_group(game, group):
+    """گروه را حذف، خانه‌های آن را با بلوک‌های رنگی تصادفی جدید پر و برچسب‌ها را به‌روز می‌کند."""
+    board, parent, size = game['board'], game['parent'], game['size']
+    game['movable'] -= 1
+    for idx in group:
+        board[idx] = random.randint(1, len(SAMEGAME_COLORS))
+        parent[idx] = idx
+        size[idx] = 1
+    _samegame_link(game, group)
 
 async def render_samegame_board(game, is_finished=False):
     """صفحه بازی جفت‌ها را برای نمایش به کاربر رندر می‌کند."""
     game_id = game['game_id']
-    board = game['board']
+    board, width, height = game['board'], game['width'], game['height']
     score = game['score']
+    cells = [SAMEGAME_COLORS[color - 1] for color in board]
     
     text = f"✨ **بازی جفت‌ها (بی‌پایان)**\nامتیاز: **{score}**"
     
@@ -2652,14 +3666,14 @@ async def render_samegame_board(game, is_finished=False):
         text += f"\n\n☠️ **حرکت دیگری باقی نمانده! بازی تمام شد.**"
         # رندر کردن بورد نهایی بدون دکمه
         keyboard = []
-        for r in range(SAMEGAME_HEIGHT):
-            row_buttons = [InlineKeyboardButton(board[r][c], callback_data=f"samegame_noop_{game_id}") for c in range(SAMEGAME_WIDTH)]
+        for r in range(height):
+            row_buttons = [InlineKeyboardButton(cells[r * width + c], callback_data=f"samegame_noop_{game_id}") for c in range(width)]
             keyboard.append(row_buttons)
         return text, InlineKeyboardMarkup(keyboard)
 
     keyboard = []
-    for r in range(SAMEGAME_HEIGHT):
-        row_buttons = [InlineKeyboardButton(board[r][c], callback_data=f"samegame_click_{game_id}_{r}_{c}") for c in range(SAMEGAME_WIDTH)]
+    for r in range(height):
+        row_buttons = [InlineKeyboardButton(cells[r * width + c], callback_data=f"samegame_click_{game_id}_{r}_{c}") for c in range(width)]
         keyboard.append(row_buttons)
         
     keyboard.append([InlineKeyboardButton("✖️ بستن بازی", callback_data=f"samegame_close_{game_id}")])
@@ -2667,12 +3681,11 @@ async def render_samegame_board(game, is_finished=False):
     return text, InlineKeyboardMarkup(keyboard)
 
 # --- تابع اصلی و بازنویسی شده SameGame ---
-async def samegame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def samegame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
-    data = query.data.split('_')
     action = data[1]
 
     if action == "start":
@@ -2697,7 +3710,7 @@ async def samegame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sent_message = await query.message.reply_text("در حال ساخت بازی جفت‌ها...")
         game_id = sent_message.message_id
         
-        game = { "game_id": game_id, "player_id": user.id, "board": create_samegame_board(), "score": 0 }
+        game = { "game_id": game_id, "player_id": user.id, **create_samegame_state(), "score": 0 }
         active_games['samegame'][chat_id][game_id] = game
         
         text, reply_markup = await render_samegame_board(game)
@@ -2723,14 +3736,17 @@ async def samegame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id != game.get('player_id'):
         await query.answer("این بازی برای شما نیست!", show_alert=True)
         return
+    touch_game(game)
         
     if action == "click":
         try:
             r, c = int(data[3]), int(data[4])
         except (ValueError, IndexError):
             return
+        if not (0 <= r < game['height'] and 0 <= c < game['width']):
+            return
 
-        group = find_samegame_group(game['board'], r, c)
+        group = find_samegame_group(game, r, c)
         
         if len(group) < 2:
             await query.answer("باید حداقل دو بلوک همرنگ کنار هم باشند!", show_alert=True)
@@ -2741,12 +3757,9 @@ async def samegame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         score_increment = len(group)
         game['score'] += score_increment
         
-        for row, col in group:
-            game['board'][row][col] = EMPTY_CELL
-        
-        game['board'] = refill_samegame_board_randomly(game['board'])
+        remove_samegame_group(game, group)
 
-        if is_game_over_samegame(game['board']):
+        if game['movable'] == 0:
             text, reply_markup = await render_samegame_board(game, is_finished=True)
             await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
             del active_games['samegame'][chat_id][game_id]
@@ -2766,58 +3779,271 @@ async def samegame_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- ثابت‌های پازل کشویی ---
 SPUZZLE_SIZE = 4
-
-# --- توابع کمکی پازل (منطق اصلی بدون تغییر) ---
-
-def create_solvable_spuzzle():
-    """یک پازل درهم‌ریخته اما قابل حل ایجاد می‌کند."""
-    board = list(range(1, SPUZZLE_SIZE * SPUZZLE_SIZE)) + [0]
-    
-    flat_board = list(board)
-    empty_pos = len(flat_board) - 1
-    
-    for _ in range(300): # تعداد حرکات برای درهم‌ریختن
-        moves = []
-        if empty_pos < SPUZZLE_SIZE * (SPUZZLE_SIZE - 1): moves.append('up')
-        if empty_pos >= SPUZZLE_SIZE: moves.append('down')
-        if empty_pos % SPUZZLE_SIZE < SPUZZLE_SIZE - 1: moves.append('left')
-        if empty_pos % SPUZZLE_SIZE > 0: moves.append('right')
-        
-        move = random.choice(moves)
-        
-        if move == 'up':
-            swap_with = empty_pos + SPUZZLE_SIZE
-        elif move == 'down':
-            swap_with = empty_pos - SPUZZLE_SIZE
-        elif move == 'left':
-            swap_with = empty_pos + 1
-        else: # right
-            swap_with = empty_pos - 1
-            
-        flat_board[empty_pos], flat_board[swap_with] = flat_board[swap_with], flat_board[empty_pos]
-        empty_pos = swap_with
-
-    return [flat_board[i:i+SPUZZLE_SIZE] for i in range(0, len(flat_board), SPUZZLE_SIZE)]
-
-
-def is_spuzzle_solved(board):
+SPUZZLE_HINT_TIME_BUDGET = float(os.environ.get("SPUZZLE_HINT_TIME_BUDGET", "3")) # حداکثر زمان حل برای راهنما (ثانیه)
+SPUZZLE_SOLVER_WORKERS = int(os.environ.get("SPUZZLE_SOLVER_WORKERS", "1"))
+SPUZZLE_OPTIMAL_SHARE = 0.4 # سهم جستجوی بهینه از زمان راهنما؛ بقیه برای جستجوی وزن‌دار
+SPUZZLE_FALLBACK_WEIGHTS = (2, 3, 5) # وزن‌های هیوریستیک در جستجوی غیربهینه؛ هر کدام سهم برابری از زمان باقی‌مانده دارد
+# ایموجی دکمه هر جهت (جهت‌ها حرکت کاشی را نشان می‌دهند، نه خانه خالی)
+SPUZZLE_DIRECTION_ARROWS = {'up': '⬆️', 'down': '⬇️', 'left': '⬅️', 'right': '➡️'}
+
+# --- توابع کمکی پازل ---
+# صفحه یک لیست تخت size*size است (۰ = خانه خالی) و هدف، اعداد مرتب با خانه خالی در انتها است.
+
+_SPUZZLE_GOALS = {}
+
+def spuzzle_goal(size):
+    """وضعیت حل شده پازل به صورت تاپل (برای هر اندازه فقط یک بار ساخته می‌شود)."""
+    goal = _SPUZZLE_GOALS.get(size)
+    if goal is None:
+        goal = _SPUZZLE_GOALS[size] = tuple(range(1, size * size)) + (0,)
+    return goal
+
+def _permutation_parity(board):
+    """زوج یا فرد بودن جایگشت کاشی‌ها (بدون خانه خالی) با شمارش دورها در O(n)."""
+    tiles = [t for t in board if t]
+    seen = bytearray(len(tiles))
+    cycles = 0
+    for start in range(len(tiles)):
+        if seen[start]:
+            continue
+        cycles += 1
+        i = start
+        while not seen[i]:
+            seen[i] = 1
+            i = tiles[i] - 1
+    return (len(tiles) - cycles) % 2
+
+def is_spuzzle_solvable(board, size):
+    """برای عرض فرد، جایگشت باید زوج باشد؛ برای عرض زوج، جایگشت به علاوه فاصله سطر خانه خالی تا پایین باید زوج باشد."""
+    parity = _permutation_parity(board)
+    if size % 2 == 0:
+        parity += size - 1 - board.index(0) // size
+    return parity % 2 == 0
+
+def create_solvable_spuzzle(size=SPUZZLE_SIZE):
+    """یک جایگشت کاملاً تصادفی می‌سازد و در صورت حل‌نشدنی بودن با جابه‌جایی دو کاشی آن را اصلاح می‌کند."""
+    goal = spuzzle_goal(size)
+    while True:
+        board = list(goal)
+        random.shuffle(board)
+        if not is_spuzzle_solvable(board, size):
+            # جابه‌جایی دو کاشی غیرخالی زوجیت جایگشت را عوض می‌کند
+            i, j = [k for k, t in enumerate(board) if t][:2]
+            board[i], board[j] = board[j], board[i]
+        if tuple(board) != goal:
+            return board
+
+def is_spuzzle_solved(board, size=SPUZZLE_SIZE):
     """بررسی می‌کند که آیا پازل حل شده است یا خیر."""
-    solved_board = list(range(1, SPUZZLE_SIZE * SPUZZLE_SIZE)) + [0]
-    current_flat_board = [cell for row in board for cell in row]
-    return solved_board == current_flat_board
+    return tuple(board) == spuzzle_goal(size)
+
+class _SpuzzleTimeout(Exception):
+    pass
+
+def _spuzzle_line_penalty(goal_offsets):
+    """جریمه linear conflict یک سطر/ستون: دو برابر تعداد کاشی‌هایی که باید از خط خارج شوند تا بقیه مرتب باشند."""
+    count = len(goal_offsets)
+    if count < 2:
+        return 0
+    longest = [1] * count
+    for i in range(1, count):
+        for j in range(i):
+            if goal_offsets[j] < goal_offsets[i] and longest[j] >= longest[i]:
+                longest[i] = longest[j] + 1
+    return 2 * (count - max(longest))
+
+def spuzzle_heuristic(board, size):
+    """Manhattan + linear conflict کل صفحه."""
+    manhattan = 0
+    for pos, tile in enumerate(board):
+        if tile:
+            goal_r, goal_c = divmod(tile - 1, size)
+            r, c = divmod(pos, size)
+            manhattan += abs(goal_r - r) + abs(goal_c - c)
+    conflicts = sum(_spuzzle_line_penalty([(t - 1) % size for t in board[r * size:(r + 1) * size] if t and (t - 1) // size == r]) for r in range(size))
+    conflicts += sum(_spuzzle_line_penalty([(t - 1) // size for t in board[c::size] if t and (t - 1) % size == c]) for c in range(size))
+    return manhattan + conflicts
+
+def _spuzzle_neighbors(size):
+    neighbors = []
+    for pos in range(size * size):
+        r, c = divmod(pos, size)
+        neighbors.append(tuple(n for n, ok in ((pos - size, r > 0), (pos + size, r < size - 1), (pos - 1, c > 0), (pos + 1, c < size - 1)) if ok))
+    return neighbors
+
+def solve_spuzzle_weighted(board, size, weight, deadline):
+    """
+    جستجوی Weighted A* (f = g + weight * h): راه حل کوتاه ولی نه لزوماً بهینه را خیلی سریع‌تر پیدا می‌کند.
+    لیست خانه‌هایی که خانه خالی به آن‌ها می‌رود یا None در صورت اتمام زمان را برمی‌گرداند.
+    """
+    neighbors = _spuzzle_neighbors(size)
+    start = bytes(board)
+    parents = {start: None}
+    heap = [(weight * spuzzle_heuristic(start, size), 0, start, start.index(0))]
+    nodes = 0
+    while heap:
+        _, g, state, blank = heapq.heappop(heap)
+        if spuzzle_heuristic(state, size) == 0:
+            path = []
+            while parents[state] is not None:
+                path.append(state.index(0))
+                state = parents[state]
+            return path[::-1]
+        nodes += 1
+        if nodes & 0xFF == 0 and time.monotonic() > deadline:
+            return None
+        for target in neighbors[blank]:
+            child = bytearray(state)
+            child[blank], child[target] = child[target], 0
+            child = bytes(child)
+            if child in parents:
+                continue
+            parents[child] = state
+            heapq.heappush(heap, (g + 1 + weight * spuzzle_heuristic(child, size), g + 1, child, target))
+    return None
+
+def solve_spuzzle_hint(board, size, time_budget):
+    """
+    حرکت بعدی راهنما را پیدا می‌کند و (خانه بعدی خانه خالی، تعداد حرکات، نوع راه حل) برمی‌گرداند.
+    اول راه حل بهینه (IDA*) امتحان می‌شود؛ اگر زمانش تمام شد Weighted A* و در نهایت بهترین حرکت حریصانه،
+    تا همیشه یک حرکت پیشنهاد شود. نوع راه حل 'optimal'، 'weighted' یا 'greedy' است؛
+    در حالت greedy تعداد حرکات کران پایین است. برای اجرا در پروسس جداگانه طراحی شده است.
+    """
+    started = time.monotonic()
+    path, moves = solve_spuzzle(board, size, time_budget * SPUZZLE_OPTIMAL_SHARE)
+    if path is not None:
+        return (path[0] if path else None), moves, 'optimal'
+    deadline = started + time_budget
+    for index, weight in enumerate(SPUZZLE_FALLBACK_WEIGHTS):
+        # وزن کم راه حل کوتاه‌تری می‌دهد ولی در صفحه‌های بزرگ تمام نمی‌شود؛ پس هر وزن فقط سهم خود از زمان را دارد
+        now = time.monotonic()
+        share = (deadline - now) / (len(SPUZZLE_FALLBACK_WEIGHTS) - index)
+        path = solve_spuzzle_weighted(board, size, weight, now + share)
+        if path is not None:
+            return path[0], len(path), 'weighted'
+    # حرکتی که هیوریستیک را بیشترین کاهش می‌دهد
+    blank = board.index(0)
+    scores = []
+    for target in _spuzzle_neighbors(size)[blank]:
+        child = list(board)
+        child[blank], child[target] = child[target], 0
+        scores.append((spuzzle_heuristic(child, size), target))
+    return min(scores)[1], moves, 'greedy'
+
+def solve_spuzzle(board, size, time_budget):
+    """
+    کوتاه‌ترین راه حل را با IDA* و هیوریستیک Manhattan + linear conflict پیدا می‌کند.
+    خروجی (لیست خانه‌هایی که خانه خالی به ترتیب به آن‌ها می‌رود یا None در صورت اتمام زمان، کران پایین تعداد حرکات) است.
+    برای اجرا در پروسس جداگانه طراحی شده است.
+    """
+    deadline = time.monotonic() + time_budget
+    board = list(board)
+    neighbors = _spuzzle_neighbors(size)
+
+    def row_penalty(r):
+        return _spuzzle_line_penalty([(t - 1) % size for t in board[r * size:(r + 1) * size] if t and (t - 1) // size == r])
+
+    def col_penalty(c):
+        return _spuzzle_line_penalty([(t - 1) // size for t in board[c::size] if t and (t - 1) % size == c])
+
+    def distance(tile, pos):
+        goal_r, goal_c = divmod(tile - 1, size)
+        r, c = divmod(pos, size)
+        return abs(goal_r - r) + abs(goal_c - c)
+
+    row_pen = [row_penalty(r) for r in range(size)]
+    col_pen = [col_penalty(c) for c in range(size)]
+    manhattan = sum(distance(t, pos) for pos, t in enumerate(board) if t)
+    lower_bound = manhattan + sum(row_pen) + sum(col_pen)
+    path = []
+    nodes = 0
+
+    def search(blank, previous, g, bound, md):
+        nonlocal nodes
+        h = md + sum(row_pen) + sum(col_pen)
+        f = g + h
+        if f > bound:
+            return f
+        if h == 0:
+            return True
+        nodes += 1
+        if nodes & 0xFFF == 0 and time.monotonic() > deadline:
+            raise _SpuzzleTimeout()
+        minimum = None
+        for target in neighbors[blank]:
+            if target == previous:
+                continue
+            tile = board[target]
+            new_md = md - distance(tile, target) + distance(tile, blank)
+            board[blank], board[target] = tile, 0
+            if blank // size == target // size:
+                # حرکت افقی: فقط ستون‌های مبدا و مقصد تغییر می‌کنند
+                lines, penalties, compute = (target % size, blank % size), col_pen, col_penalty
+            else:
+                lines, penalties, compute = (target // size, blank // size), row_pen, row_penalty
+            saved = [penalties[i] for i in lines]
+            for i in lines:
+                penalties[i] = compute(i)
+            path.append(target)
+            result = search(target, blank, g + 1, bound, new_md)
+            if result is True:
+                return True
+            path.pop()
+            for i, value in zip(lines, saved):
+                penalties[i] = value
+            board[target], board[blank] = tile, 0
+            if minimum is None or result < minimum:
+                minimum = result
+        return minimum if minimum is not None else float('inf')
+
+    bound = lower_bound
+    blank = board.index(0)
+    try:
+        while True:
+            result = search(blank, None, 0, bound, manhattan)
+            if result is True:
+                return path, len(path)
+            lower_bound = bound = result
+    except _SpuzzleTimeout:
+        return None, lower_bound
+
+spuzzle_solver_pool = None
+_spuzzle_hints_running = set()
+
+def get_spuzzle_solver_pool():
+    """پروسس‌های حل پازل (محاسبه سنگین CPU) تا اولین درخواست راهنما ساخته نمی‌شوند."""
+    global spuzzle_solver_pool
+    if spuzzle_solver_pool is None:
+        # fork از پروسسی که thread های دیتابیس، رندر و زمان‌بند دارد امن نیست
+        spuzzle_solver_pool = ProcessPoolExecutor(max_workers=max(1, SPUZZLE_SOLVER_WORKERS), mp_context=multiprocessing.get_context("forkserver"))
+    return spuzzle_solver_pool
+
+async def compute_spuzzle_hint(board, size):
+    """
+    راهنما را خارج از event loop محاسبه می‌کند و (جهت دکمه حرکت بعدی یا None اگر حل شده باشد، تعداد حرکات، نوع راه حل) برمی‌گرداند.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_spuzzle_solver_pool(), solve_spuzzle_hint, tuple(board), size, SPUZZLE_HINT_TIME_BUDGET)
+    target, moves, kind = await asyncio.wait_for(future, timeout=SPUZZLE_HINT_TIME_BUDGET + 5)
+    if target is None:
+        return None, moves, kind
+    # جهت دکمه‌ها حرکت کاشی را نشان می‌دهد که عکس حرکت خانه خالی است
+    delta = target - board.index(0)
+    direction = {size: 'up', -size: 'down', 1: 'left', -1: 'right'}[delta]
+    return direction, moves, kind
 
 async def render_spuzzle(game):
     """صفحه پازل کشویی را رندر می‌کند."""
     game_id = game['game_id']
-    board = game['board']
+    board, size = game['board'], game['size']
     
     text = "🔢 **پازل کشویی**\n\nاعداد را مرتب کنید:"
     
     keyboard = []
-    for r in range(SPUZZLE_SIZE):
+    for r in range(size):
         row_buttons = []
-        for c in range(SPUZZLE_SIZE):
-            cell = board[r][c]
+        for c in range(size):
+            cell = board[r * size + c]
             text_cell = str(cell) if cell != 0 else " "
             row_buttons.append(InlineKeyboardButton(text_cell, callback_data=f"spuzzle_noop_{game_id}"))
         keyboard.append(row_buttons)
@@ -2828,17 +4054,61 @@ async def render_spuzzle(game):
         InlineKeyboardButton("⬇️", callback_data=f"spuzzle_move_{game_id}_down"),
         InlineKeyboardButton("➡️", callback_data=f"spuzzle_move_{game_id}_right")
     ])
-    keyboard.append([InlineKeyboardButton("✖️ بستن بازی", callback_data=f"spuzzle_close_{game_id}")])
+    keyboard.append([
+        InlineKeyboardButton("💡 راهنما", callback_data=f"spuzzle_hint_{game_id}"),
+        InlineKeyboardButton("✖️ بستن بازی", callback_data=f"spuzzle_close_{game_id}")
+    ])
     
     return text, InlineKeyboardMarkup(keyboard)
 
+async def spuzzle_hint(query, context: ContextTypes.DEFAULT_TYPE, chat_id, game_id):
+    """
+    محاسبه راهنما را در پس‌زمینه شروع می‌کند و بلافاصله برمی‌گردد تا هندلر قفل چت را آزاد کند؛
+    پاسخ دکمه پس از آماده شدن راهنما توسط _deliver_spuzzle_hint داده می‌شود.
+    """
+    user = query.from_user
+    game = active_games['spuzzle'].get(chat_id, {}).get(game_id)
+    if not game:
+        await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
+        return
+    if user.id != game.get('player_id'):
+        await query.answer("این بازی برای شما نیست!", show_alert=True)
+        return
+    key = (chat_id, game_id)
+    if key in _spuzzle_hints_running:
+        await query.answer("راهنما در حال محاسبه است، کمی صبر کنید...")
+        return
+
+    # محاسبه روی کپی صفحه انجام می‌شود؛ حرکت‌های بعدی بازیکن منتظر آن نمی‌مانند
+    _spuzzle_hints_running.add(key)
+    context.application.create_task(_deliver_spuzzle_hint(query, key, list(game['board']), game['size']))
+
+async def _deliver_spuzzle_hint(query, key, board, size):
+    """حرکت بعدی و تعداد حرکات باقی‌مانده را به عنوان پاسخ دکمه راهنما نشان می‌دهد."""
+    try:
+        direction, moves, kind = await compute_spuzzle_hint(board, size)
+    except Exception as e:
+        logger.warning(f"Sliding puzzle hint failed for {key}: {e}")
+        await query.answer("محاسبه راهنما ممکن نشد. دوباره تلاش کنید.", show_alert=True)
+        return
+    finally:
+        _spuzzle_hints_running.discard(key)
+
+    if not direction:
+        await query.answer("پازل حل شده است!", show_alert=True)
+    elif kind == 'optimal':
+        await query.answer(f"💡 حرکت بعدی: {SPUZZLE_DIRECTION_ARROWS[direction]}\nحداقل {moves} حرکت تا حل پازل باقی مانده است.", show_alert=True)
+    elif kind == 'weighted':
+        await query.answer(f"💡 حرکت پیشنهادی: {SPUZZLE_DIRECTION_ARROWS[direction]}\nبا این مسیر {moves} حرکت تا حل پازل باقی مانده است.", show_alert=True)
+    else:
+        await query.answer(f"💡 حرکت پیشنهادی: {SPUZZLE_DIRECTION_ARROWS[direction]}\nحداقل {moves} حرکت تا حل پازل باقی مانده است.", show_alert=True)
+
 # --- تابع اصلی و بازنویسی شده پازل ---
-async def spuzzle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def spuzzle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
-    data = query.data.split('_')
     action = data[1]
 
     if action == "start":
@@ -2864,9 +4134,9 @@ async def spuzzle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         game = {
             "game_id": game_id, "player_id": user.id,
-            "board": create_solvable_spuzzle(),
-            "start_time": time.time(),
-            "is_busy": False  # ۱. کلید قفل اضافه شد
+            "board": create_solvable_spuzzle(SPUZZLE_SIZE),
+            "size": SPUZZLE_SIZE,
+            "start_time": time.time()
         }
         active_games['spuzzle'][chat_id][game_id] = game
         
@@ -2885,34 +4155,26 @@ async def spuzzle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("خطای دکمه.", show_alert=True)
         return
 
-    if chat_id not in active_games['spuzzle'] or game_id not in active_games['spuzzle'][chat_id]:
-        await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
-        return
-        
-    game = active_games['spuzzle'][chat_id][game_id]
-
-    if user.id != game.get('player_id'):
-        await query.answer("این بازی برای شما نیست!", show_alert=True)
+    if action == "hint":
+        await spuzzle_hint(query, context, chat_id, game_id)
         return
 
-    # ۲. بررسی وضعیت قفل در ابتدای پردازش
-    if game.get('is_busy', False):
-        await query.answer("کمی صبر کنید...")
-        return
-    
-    await query.answer() # پاسخ اولیه به کلیک
+    # حرکت‌های یک پازل با قفل اختصاصی همان بازی به ترتیب اعمال می‌شوند
+    async with get_game_lock('spuzzle', chat_id, game_id):
+        game = active_games['spuzzle'].get(chat_id, {}).get(game_id)
+        if not game:
+            await query.answer("این بازی دیگر فعال نیست.", show_alert=True)
+            return
+        if user.id != game.get('player_id'):
+            await query.answer("این بازی برای شما نیست!", show_alert=True)
+            return
+        touch_game(game)
 
-    if action == "move":
-        # ۳. اعمال قفل با try...finally
-        game['is_busy'] = True
-        try:
+        if action == "move":
             direction = data[3]
-            board = game['board']
-            empty_r, empty_c = -1, -1
-            for r_idx, row in enumerate(board):
-                if 0 in row:
-                    empty_r, empty_c = r_idx, row.index(0)
-                    break
+            board, size = game['board'], game['size']
+            empty = board.index(0)
+            empty_r, empty_c = divmod(empty, size)
 
             tile_r, tile_c = empty_r, empty_c
             if direction == 'up': tile_r += 1
@@ -2920,43 +4182,43 @@ async def spuzzle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif direction == 'left': tile_c += 1
             elif direction == 'right': tile_c -= 1
             
-            if 0 <= tile_r < SPUZZLE_SIZE and 0 <= tile_c < SPUZZLE_SIZE:
-                board[empty_r][empty_c], board[tile_r][tile_c] = board[tile_r][tile_c], board[empty_r][empty_c]
-
-                if is_spuzzle_solved(board):
-                    duration = time.time() - game['start_time']
-                    
-                    final_text = (
-                        f"🏆 **تبریک {user.mention_html()}!** 🏆\n\n"
-                        f"شما پازل را در زمان **{int(duration)} ثانیه** حل کردید!"
-                    )
-                    
-                    # رندر نهایی صفحه بدون دکمه‌های کنترل
-                    final_board_text, _ = await render_spuzzle(game)
-                    
-                    await query.edit_message_text(
-                        f"{final_board_text}\n\n{final_text}",
-                        reply_markup=None,
-                        parse_mode=ParseMode.HTML
-                    )
-                    del active_games['spuzzle'][chat_id][game_id]
-                    return # چون بازی تمام شده، زودتر خارج می‌شویم
-                
-                text, reply_markup = await render_spuzzle(game)
-                await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-            else:
+            if not (0 <= tile_r < size and 0 <= tile_c < size):
                 await query.answer("حرکت غیرمجاز!")
-        finally:
-            # آزاد کردن قفل در هر حالتی
-            if chat_id in active_games['spuzzle'] and game_id in active_games['spuzzle'][chat_id]:
-                active_games['spuzzle'][chat_id][game_id]['is_busy'] = False
+                return
 
-    elif action == "close":
-        await query.edit_message_text("پازل کشویی بسته شد.")
-        del active_games['spuzzle'][chat_id][game_id]
+            await query.answer()
+            tile = tile_r * size + tile_c
+            board[empty], board[tile] = board[tile], 0
 
-    elif action == "noop":
-        pass
+            if is_spuzzle_solved(board, size):
+                duration = time.time() - game['start_time']
+                
+                final_text = (
+                    f"🏆 **تبریک {user.mention_html()}!** 🏆\n\n"
+                    f"شما پازل را در زمان **{int(duration)} ثانیه** حل کردید!"
+                )
+                
+                # رندر نهایی صفحه بدون دکمه‌های کنترل
+                final_board_text, _ = await render_spuzzle(game)
+                
+                del active_games['spuzzle'][chat_id][game_id]
+                await query.edit_message_text(
+                    f"{final_board_text}\n\n{final_text}",
+                    reply_markup=None,
+                    parse_mode=ParseMode.HTML
+                )
+                return # چون بازی تمام شده، زودتر خارج می‌شویم
+            
+            text, reply_markup = await render_spuzzle(game)
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
+        elif action == "close":
+            await query.answer()
+            del active_games['spuzzle'][chat_id][game_id]
+            await query.edit_message_text("پازل کشویی بسته شد.")
+
+        elif action == "noop":
+            await query.answer()
 
 # ========================= SLIDING PUZZLE CODE (END) - v2 ==========================
 # ======================== 4-PLAYER DOZ CODE (START) =========================
@@ -2965,32 +4227,6 @@ async def spuzzle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 DOZ4P_SIZE = 10
 DOZ4P_SYMBOLS = ["🔴", "🔵", "🟢", "🟡"]
 
-# --- توابع کمکی (منطق اصلی بدون تغییر) ---
-
-def check_doz4p_winner(board, symbol):
-    """بررسی می‌کند که آیا بازیکنی با نماد 'symbol' برنده شده است (۴ مهره در یک ردیف)."""
-    # بررسی افقی
-    for r in range(DOZ4P_SIZE):
-        for c in range(DOZ4P_SIZE - 3):
-            if all(board[r][c+i] == symbol for i in range(4)):
-                return True
-    # بررسی عمودی
-    for r in range(DOZ4P_SIZE - 3):
-        for c in range(DOZ4P_SIZE):
-            if all(board[r+i][c] == symbol for i in range(4)):
-                return True
-    # بررسی مورب (پایین به بالا)
-    for r in range(3, DOZ4P_SIZE):
-        for c in range(DOZ4P_SIZE - 3):
-            if all(board[r-i][c+i] == symbol for i in range(4)):
-                return True
-    # بررسی مورب (بالا به پایین)
-    for r in range(DOZ4P_SIZE - 3):
-        for c in range(DOZ4P_SIZE - 3):
-            if all(board[r+i][c+i] == symbol for i in range(4)):
-                return True
-    return False
-
 # --- تابع رندر بهینه‌سازی شده ---
 
 async def render_doz4p_board(game, is_finished=False):
@@ -3017,14 +4253,13 @@ async def render_doz4p_board(game, is_finished=False):
 
 # --- تابع اصلی و بازنویسی شده دوز ۴ نفره ---
 
-async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
 
     # if await check_ban_status(update, context): return
     
-    data = query.data.split('_')
     action = data[1]
 
     if action == "start":
@@ -3039,7 +4274,7 @@ async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         if chat_id not in active_games['doz4p']:
-            active_games['doz4p'] = {chat_id: {}}
+            active_games['doz4p'][chat_id] = {}
         
         sent_message = await query.message.reply_text("در حال ساخت بازی دوز چهار نفره...")
         game_id = sent_message.message_id
@@ -3048,6 +4283,7 @@ async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "game_id": game_id, "status": "joining",
             "players_info": [{'id': user.id, 'name': user.first_name, 'symbol': DOZ4P_SYMBOLS[0]}],
             "board": [['▪️'] * DOZ4P_SIZE for _ in range(DOZ4P_SIZE)],
+            "moves": 0,
             "turn_index": 0
         }
         active_games['doz4p'][chat_id][game_id] = game
@@ -3072,6 +4308,8 @@ async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     game = active_games['doz4p'][chat_id][game_id]
+    if is_game_participant(game, user.id):
+        touch_game(game)
 
     if action == "join":
         if not await check_join_for_alert(update, context):
@@ -3087,6 +4325,7 @@ async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             await query.answer()
         game['players_info'].append({'id': user.id, 'name': user.first_name, 'symbol': DOZ4P_SYMBOLS[num_players]})
+        touch_game(game)
         
         if num_players + 1 < 4:
             player_names = "، ".join([p['name'] for p in game['players_info']])
@@ -3115,9 +4354,10 @@ async def doz4p_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         symbol = turn_player['symbol']
         game['board'][r][c] = symbol
+        game['moves'] += 1
 
-        is_winner = check_doz4p_winner(game['board'], symbol)
-        is_draw = all(cell != '▪️' for row in game['board'] for cell in row) and not is_winner
+        is_winner = completes_line(game['board'], r, c, 4)
+        is_draw = game['moves'] == DOZ4P_SIZE * DOZ4P_SIZE and not is_winner
 
         if is_winner or is_draw:
             game['status'] = 'finished'
@@ -3163,12 +4403,11 @@ async def render_gardone_board(game: dict):
     ]
     return text, InlineKeyboardMarkup(keyboard)
 
-async def gardone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def gardone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
     chat_id = query.message.chat.id
     
-    data = query.data.split('_')
     action = data[1]
 
     if action == "start":
@@ -3223,6 +4462,8 @@ async def gardone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     game = active_games['gardone'][chat_id]
+    if is_game_participant(game, user.id):
+        touch_game(game)
 
     if action == "join":
         # ۱. ابتدا عضویت در کانال را چک می‌کنیم
@@ -3236,6 +4477,7 @@ async def gardone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # ۳. کاربر را به لیست اضافه می‌کنیم
         game['participants'].append({'id': user.id, 'name': user.first_name})
+        touch_game(game)
         await query.answer("شما با موفقیت به گردونه شانس پیوستید!")
         
         # ۴. پیام را با لیست جدید به‌روزرسانی می‌کنیم
@@ -3273,10 +4515,9 @@ async def gardone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ========================= GARDONE SHANS (END) ==========================
 # ======================== 4-PLAYER DOZ CODE (END) =========================
 # --------------------------- GAME: HADS KALAME (با جان جداگانه) ---------------------------
-async def hads_kalame_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def hads_kalame_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
-    data = query.data.split('_')
     try:
         target_user_id = int(data[-1])
     except (ValueError, IndexError):
@@ -3307,7 +4548,9 @@ async def handle_letter_guess(update: Update, context: ContextTypes.DEFAULT_TYPE
     if await check_ban_status(update, context): return
 
     guess = update.message.text.strip()
-    game = active_games['hangman'][chat_id]
+    game = active_games['hangman'].get(chat_id)
+    if not game: return
+    touch_game(game)
     
     if user.id not in game['players']: game['players'][user.id] = INITIAL_LIVES
     if game['players'][user.id] == 0: 
@@ -3342,29 +4585,137 @@ async def handle_letter_guess(update: Update, context: ContextTypes.DEFAULT_TYPE
                 del active_games['hangman'][chat_id]
 
 # --------------------------- GAME: TYPE SPEED ---------------------------
-def create_typing_image(text: str) -> io.BytesIO:
+# --- اجرای رندر تصاویر در Thread Pool ---
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "2"))
+RENDER_MAX_PENDING = int(os.environ.get("RENDER_MAX_PENDING", "32")) # حداکثر کارهای رندر همزمان در صف
+
+class RenderPool:
+    """
+    کارهای سنگین PIL (رسم و کد کردن تصویر) را خارج از event loop اجرا می‌کند.
+    PIL در هنگام رسم و فشرده‌سازی GIL را آزاد می‌کند، پس Thread Pool کافی است.
+    تعداد کارهای در صف محدود است و آمار عمق صف برای /stats نگهداری می‌شود.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="render")
+        self._slots = asyncio.Semaphore(max(1, max_pending))
+        self.queue_depth = 0 # کارهای ثبت شده و تمام نشده (در انتظار + در حال اجرا)
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+
+    async def run(self, func, *args):
+        """func را در یکی از تردهای رندر اجرا و نتیجه را برمی‌گرداند."""
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        started = time.monotonic()
+        try:
+            async with self._slots:
+                result = await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.queue_depth -= 1
+        self.completed += 1
+        self.total_seconds += time.monotonic() - started
+        return result
+
+    def stats_text(self) -> str:
+        average_ms = (self.total_seconds / self.completed * 1000) if self.completed else 0
+        return (f"صف: {self.queue_depth} (بیشینه {self.max_queue_depth}) | "
+                f"انجام شده: {self.completed} | خطا: {self.failed} | میانگین: {average_ms:.1f}ms")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_MAX_PENDING)
+
+TYPING_FONT_PATH = "Vazir.ttf"
+TYPING_FONT_SIZE = 24
+TYPING_IMAGE_CACHE_SIZE = int(os.environ.get("TYPING_IMAGE_CACHE_SIZE", "256")) # تعداد تصاویر JPEG نگهداری شده در حافظه
+_typing_font = None
+_typing_font_lock = threading.Lock()
+typing_image_cache = OrderedDict() # جمله -> بایت‌های JPEG (به ترتیب آخرین استفاده)
+
+def get_typing_font():
+    """فونت تصویر بازی تایپ را فقط یک بار بارگذاری می‌کند."""
+    global _typing_font
+    # از چند ترد رندر صدا زده می‌شود
+    with _typing_font_lock:
+        if _typing_font is None:
+            try:
+                _typing_font = ImageFont.truetype(TYPING_FONT_PATH, TYPING_FONT_SIZE)
+            except IOError:
+                logger.warning("Vazir.ttf font not found. Falling back to default.")
+                _typing_font = ImageFont.load_default()
+    return _typing_font
+
+def render_typing_image(text: str) -> bytes:
+    """جمله را به صورت راست‌به‌چپ روی تصویر رسم و با فرمت JPEG کد می‌کند."""
     reshaped_text = arabic_reshaper.reshape(text)
     bidi_text = get_display(reshaped_text)
-    try:
-        font = ImageFont.truetype("Vazir.ttf", 24)
-    except IOError:
-        logger.warning("Vazir.ttf font not found. Falling back to default.")
-        font = ImageFont.load_default()
+    font = get_typing_font()
     
-    dummy_img, draw = Image.new('RGB', (1, 1)), ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
     _, _, w, h = draw.textbbox((0, 0), bidi_text, font=font)
     img = Image.new('RGB', (w + 40, h + 40), color=(255, 255, 255))
     ImageDraw.Draw(img).text((20, 20), bidi_text, fill=(0, 0, 0), font=font)
     bio = io.BytesIO()
-    bio.name = 'image.jpeg'
     img.save(bio, 'JPEG')
-    bio.seek(0)
+    return bio.getvalue()
+
+async def get_typing_image_bytes(text: str) -> bytes:
+    """تصویر کد شده جمله را از کش LRU برمی‌گرداند و در صورت نبود، یک بار در render_pool رندر می‌کند."""
+    image_bytes = typing_image_cache.get(text)
+    if image_bytes is not None:
+        typing_image_cache.move_to_end(text)
+        return image_bytes
+    image_bytes = await render_pool.run(render_typing_image, text)
+    typing_image_cache[text] = image_bytes
+    while len(typing_image_cache) > TYPING_IMAGE_CACHE_SIZE:
+        typing_image_cache.popitem(last=False)
+    return image_bytes
+
+async def create_typing_image(text: str) -> io.BytesIO:
+    bio = io.BytesIO(await get_typing_image_bytes(text))
+    bio.name = 'image.jpeg'
     return bio
 
-async def type_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# --- شناسه فایل تلگرام تصاویر تایپ (برای ارسال دوباره بدون آپلود) ---
+typing_file_ids = {} # جمله -> file_id
+
+async def load_typing_file_ids():
+    """file_id های ذخیره شده در دیتابیس را یک بار هنگام راه‌اندازی بارگذاری می‌کند."""
+    rows = await db_fetchall("SELECT sentence, file_id FROM typing_images;")
+    if rows is not None:
+        typing_file_ids.update(rows)
+
+async def send_typing_image(context: ContextTypes.DEFAULT_TYPE, chat_id: int, sentence: str, caption: str):
+    """تصویر جمله را با file_id قبلی می‌فرستد؛ اگر وجود نداشت یا نامعتبر بود، آپلود و file_id جدید را ذخیره می‌کند."""
+    file_id = typing_file_ids.get(sentence)
+    if file_id:
+        try:
+            return await context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+        except BadRequest as e:
+            logger.warning(f"Cached typing image file_id rejected, re-uploading: {e}")
+            typing_file_ids.pop(sentence, None)
+            await db_execute("DELETE FROM typing_images WHERE sentence = %s;", (sentence,))
+
+    message = await context.bot.send_photo(chat_id=chat_id, photo=await create_typing_image(sentence), caption=caption)
+    if message.photo:
+        file_id = message.photo[-1].file_id
+        typing_file_ids[sentence] = file_id
+        await db_execute(
+            "INSERT INTO typing_images (sentence, file_id) VALUES (%s, %s) ON CONFLICT (sentence) DO UPDATE SET file_id = EXCLUDED.file_id;",
+            (sentence, file_id)
+        )
+    return message
+
+async def type_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     query = update.callback_query
     user = query.from_user
-    data = query.data.split('_')
     try:
         target_user_id = int(data[-1])
     except (ValueError, IndexError):
@@ -3387,15 +4738,16 @@ async def type_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     active_games['typing'][chat_id] = {"sentence": sentence, "start_time": datetime.now()}
     
     await query.edit_message_text("بازی تایپ سرعتی ۳... ۲... ۱...")
-    image_file = create_typing_image(sentence)
-    await context.bot.send_photo(chat_id=chat_id, photo=image_file, caption="سریع تایپ کنید!")
+    await send_typing_image(context, chat_id, sentence, caption="سریع تایپ کنید!")
 
 async def handle_typing_attempt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if chat_id not in active_games['typing']: return
     if await check_ban_status(update, context): return
     
-    game = active_games['typing'][chat_id]
+    game = active_games['typing'].get(chat_id)
+    if not game: return
+    touch_game(game)
     user_input = update.message.text.strip()
     
     if user_input == game['sentence']:
@@ -3497,13 +4849,12 @@ async def confirm_god(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         god_username_display = f"@{user.username}"
         active_gharch_games[chat_id] = {'god_id': god_id, 'god_username': god_username_display}
 
-        bot_username = (await context.bot.get_me()).username
         game_message_text = (
             "**بازی قارچ 🍄 شروع شد!**\n\n"
             "روی دکمه زیر کلیک کن و حرف دلت رو بنویس تا به صورت ناشناس در گروه ظاهر بشه!\n\n"
             f"*(فقط گاد بازی، {god_username_display}، از هویت ارسال‌کننده مطلع خواهد شد.)*"
         )
-        keyboard = [[InlineKeyboardButton("🍄 ارسال پیام ناشناس", url=f"https://t.me/{bot_username}?start=gharch_{chat_id}")]]
+        keyboard = [[InlineKeyboardButton("🍄 ارسال پیام ناشناس", url=f"https://t.me/{context.bot.username}?start=gharch_{chat_id}")]]
         
         await query.edit_message_text(
             text=game_message_text,
@@ -3536,10 +4887,12 @@ async def cancel_gharch_conv(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await rsgame_command(update, context)
     return ConversationHandler.END
 
-async def eteraf_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def eteraf_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list = None):
     query = update.callback_query
     user = query.from_user
-    data = query.data.split('_')
+    # نوع پیش‌فرض از route_callback_query با data صدا زده می‌شود و نوع سفارشی به عنوان نقطه ورود مکالمه بدون آن
+    if data is None:
+        data = query.data.split('_')
     try:
         target_user_id = int(data[-1])
     except (ValueError, IndexError):
@@ -3559,15 +4912,13 @@ async def eteraf_start_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer("❌ شما اجازه استفاده از این دستور را ندارید.", show_alert=True)
         return
     
-    data = query.data.split('_')
     eteraf_type = data[2] 
 
     if eteraf_type == "default":
         starter_text = "یک موضوع اعتراف جدید شروع شد. برای ارسال اعتراف ناشناس، از دکمه زیر استفاده کنید."
-        bot_username = (await context.bot.get_me()).username
         try:
             starter_message = await context.bot.send_message(chat_id, starter_text)
-            keyboard = [[InlineKeyboardButton("ارسال به صورت ناشناس", url=f"https://t.me/{bot_username}?start=eteraf_{chat_id}_{starter_message.message_id}")]]
+            keyboard = [[InlineKeyboardButton("ارسال به صورت ناشناس", url=f"https://t.me/{context.bot.username}?start=eteraf_{chat_id}_{starter_message.message_id}")]]
             await starter_message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
             await query.message.delete() 
         except Exception as e:
@@ -3592,12 +4943,11 @@ async def receive_eteraf_text(update: Update, context: ContextTypes.DEFAULT_TYPE
     # --- پایان بخش جدید ---
     custom_text = update.message.text
     chat_id = update.effective_chat.id
-    bot_username = (await context.bot.get_me()).username
     
     try:
         # ربات پیام جدید اعتراف را با دکمه ارسال می‌کند
         starter_message = await context.bot.send_message(chat_id, custom_text)
-        keyboard = [[InlineKeyboardButton("ارسال به صورت ناشناس", url=f"https://t.me/{bot_username}?start=eteraf_{chat_id}_{starter_message.message_id}")]]
+        keyboard = [[InlineKeyboardButton("ارسال به صورت ناشناس", url=f"https://t.me/{context.bot.username}?start=eteraf_{chat_id}_{starter_message.message_id}")]]
         await starter_message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logger.error(f"Error in eteraf_command (custom): {e}")
@@ -3632,6 +4982,7 @@ async def handle_anonymous_message(update: Update, context: ContextTypes.DEFAULT
             if target_chat_id in active_gharch_games:
                 sender = update.effective_user
                 god_info = active_gharch_games[target_chat_id]
+                touch_game(god_info)
                 god_id = god_info['god_id']
 
                 await context.bot.send_message(
@@ -3712,36 +5063,26 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass # اگر payload معتبر نبود، به بخش استارت معمولی می‌رود
 
     # --- بخش ۲: منطق استارت معمولی ---
-    conn = get_db_connection()
-    if conn:
-        with conn.cursor() as cur: 
-            cur.execute("INSERT INTO users (user_id, first_name, username) VALUES (%s, %s, %s) ON CONFLICT (user_id) DO NOTHING;", (user.id, user.first_name, user.username))
-            conn.commit()
+    queue_user_registration(user)
     
     # اینجا عضویت اجباری برای استارت معمولی چک نمی‌شود، فقط در بازی‌های خاص
     
     # --- بخش ۳: ارسال پیام خوشامدگویی (سفارشی یا پیش‌فرض) ---
     keyboard = [
-        [InlineKeyboardButton("➕ افزودن ربات به گروه", url=f"https://t.me/{(await context.bot.get_me()).username}?startgroup=true")],
+        [InlineKeyboardButton("➕ افزودن ربات به گروه", url=f"https://t.me/{context.bot.username}?startgroup=true")],
         #[InlineKeyboardButton("🎮 پنل بازی‌ها", callback_data="rsgame_cat_main_pv")], # دکمه پنل در PV
         [InlineKeyboardButton("👤 ارتباط با پشتیبان", url=f"https://t.me/{SUPPORT_USERNAME}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     custom_welcome_sent = False
-    if conn:
+    if start_message:
         try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT message_id, chat_id FROM start_message WHERE id = 1;")
-                start_msg_data = cur.fetchone()
-                if start_msg_data:
-                    message_id, from_chat_id = start_msg_data
-                    await context.bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, reply_markup=reply_markup)
-                    custom_welcome_sent = True
+            message_id, from_chat_id = start_message
+            await context.bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, reply_markup=reply_markup)
+            custom_welcome_sent = True
         except Exception as e:
             logger.error(f"Could not send custom start message in PV: {e}")
-        finally:
-            conn.close()
 
     if not custom_welcome_sent:
         await update.message.reply_text("سلام به راینوبازی خوش آمدید.\nبرای شروع بازی‌ها از دکمه زیر استفاده کنید.", reply_markup=reply_markup)
@@ -3765,44 +5106,208 @@ async def rsgame_pv_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def set_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_owner(update.effective_user.id): return
     if not update.message.reply_to_message: return await update.message.reply_text("روی یک پیام ریپلای کنید.")
+    global start_message, start_message_loaded
     msg = update.message.reply_to_message
-    conn = get_db_connection()
-    if conn:
-        with conn.cursor() as cur: cur.execute("INSERT INTO start_message (id, message_id, chat_id) VALUES (1, %s, %s) ON CONFLICT (id) DO UPDATE SET message_id = EXCLUDED.message_id, chat_id = EXCLUDED.chat_id;", (msg.message_id, msg.chat_id)); conn.commit()
-        conn.close()
+    if await db_execute("INSERT INTO start_message (id, message_id, chat_id) VALUES (1, %s, %s) ON CONFLICT (id) DO UPDATE SET message_id = EXCLUDED.message_id, chat_id = EXCLUDED.chat_id;", (msg.message_id, msg.chat_id)) is not None:
+        start_message = (msg.message_id, msg.chat_id)
+        start_message_loaded = True
         await update.message.reply_text("✅ پیام خوشامدگویی تنظیم شد.")
 
+async def reloadinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """پیام خوشامدگویی کش شده را دوباره از دیتابیس بارگذاری می‌کند."""
+    if not await is_owner(update.effective_user.id): return
+    if await load_start_message():
+        await update.message.reply_text("✅ پیام خوشامدگویی دوباره بارگذاری شد.")
+    else:
+        await update.message.reply_text("❌ بارگذاری پیام خوشامدگویی ناموفق بود.")
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_owner(update.effective_user.id): return
-    conn = get_db_connection()
-    if conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM users;"); user_count = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM groups;"); group_count = cur.fetchone()[0]
-            cur.execute("SELECT SUM(member_count) FROM groups;"); total_members = cur.fetchone()[0] or 0
-        stats = f"📊 **آمار ربات**\n\n👤 کاربران: {user_count}\n👥 گروه‌ها: {group_count}\n👨‍👩‍👧‍👦 مجموع اعضا: {total_members}"
+    row = await db_fetchone("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM groups), (SELECT COALESCE(SUM(member_count), 0) FROM groups);")
+    if row:
+        user_count, group_count, total_members = row
+        stats = f"📊 **آمار ربات**\n\n👤 کاربران: {user_count}\n👥 گروه‌ها: {group_count}\n👨‍👩‍👧‍👦 مجموع اعضا: {total_members}\n🖼 رندر تصاویر: {render_pool.stats_text()}"
+        rate_limiter = context.bot.rate_limiter
+        if isinstance(rate_limiter, TelegramRateLimiter):
+            stats += f"\n🚦 درخواست‌های معطل شده: {rate_limiter.delayed} | RetryAfter: {rate_limiter.retry_afters}"
         await update.message.reply_text(stats, parse_mode=ParseMode.MARKDOWN)
-        conn.close()
         
-async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE, target: str):
-    if not await is_owner(update.effective_user.id): return
-    if not update.message.reply_to_message: return await update.message.reply_text("روی یک پیام ریپلای کنید.")
-    conn, table, column = get_db_connection(), "users" if target == "users" else "groups", "user_id" if target == "users" else "group_id"
-    if not conn: return
-    with conn.cursor() as cur: cur.execute(f"SELECT {column} FROM {table};"); targets = cur.fetchall()
-    conn.close()
-    if not targets: return await update.message.reply_text("هدفی یافت نشد.")
-    
-    sent, failed = 0, 0
-    status_msg = await update.message.reply_text(f"⏳ در حال ارسال به {len(targets)} {target}...")
-    for (target_id,) in targets:
+# --- ارسال همگانی (همزمان و قابل ادامه پس از ری‌استارت) ---
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8")) # حداکثر ارسال همزمان
+BROADCAST_PER_SECOND = float(os.environ.get("BROADCAST_PER_SECOND", "20")) # سهم ارسال همگانی از سقف کلی؛ بقیه برای بازی‌ها می‌ماند
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", "200")) # تعداد هدف‌های هر صفحه (هر صفحه یک checkpoint، و یک checkpoint جزئی هنگام توقف)
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", "15")) # فاصله ویرایش پیام وضعیت (ثانیه)
+BROADCAST_START_CURSOR = -(2 ** 63) # کوچک‌تر از هر آیدی (آیدی گروه‌ها منفی است)
+BROADCAST_TARGETS = {"users": ("users", "user_id"), "groups": ("groups", "group_id")}
+# خطاهایی که یعنی ارسال به این هدف دیگر هرگز موفق نمی‌شود
+UNREACHABLE_ERROR_MARKERS = ('chat not found', 'user is deactivated', 'peer_id_invalid', 'chat_write_forbidden', 'group chat was upgraded')
+running_broadcasts = {} # broadcast_id -> asyncio.Task
+
+def broadcast_progress_text(job: dict, finished: bool = False) -> str:
+    done = job['sent'] + job['failed'] + job['unreachable']
+    title = "🏁 ارسال تمام شد." if finished else f"⏳ در حال ارسال به {job['total']} {job['target']}... ({done}/{job['total']})"
+    return f"{title}\n\n✅ موفق: {job['sent']}\n❌ ناموفق: {job['failed']}\n🚫 غیرقابل دسترس: {job['unreachable']}"
+
+async def _send_broadcast_item(bot, job: dict, target_id: int, budget: TokenBucket, slots: asyncio.Semaphore) -> str:
+    """پیام را برای یک هدف فوروارد می‌کند و یکی از 'sent' / 'failed' / 'unreachable' را برمی‌گرداند."""
+    async with slots:
+        await budget.acquire()
         try:
-            await context.bot.forward_message(chat_id=target_id, from_chat_id=update.message.reply_to_message.chat.id, message_id=update.message.reply_to_message.message_id)
-            sent += 1
+            # RetryAfter در TelegramRateLimiter مدیریت و تکرار می‌شود
+            await bot.forward_message(chat_id=target_id, from_chat_id=job['from_chat_id'], message_id=job['message_id'])
+            return 'sent'
+        except Forbidden:
+            return 'unreachable'
+        except BadRequest as e:
+            if any(marker in str(e).lower() for marker in UNREACHABLE_ERROR_MARKERS):
+                return 'unreachable'
+            logger.error(f"Broadcast failed for {target_id}: {e}")
+            return 'failed'
         except Exception as e:
-            failed += 1
             logger.error(f"Broadcast failed for {target_id}: {e}")
-    await status_msg.edit_text(f"🏁 ارسال تمام شد.\n\n✅ موفق: {sent}\n❌ ناموفق: {failed}")
+            return 'failed'
+
+def _save_broadcast_page(cur, job, table, column, unreachable_ids):
+    """هدف‌های غیرقابل دسترس و checkpoint ارسال را در یک تراکنش ذخیره می‌کند."""
+    if unreachable_ids:
+        cur.execute(f"UPDATE {table} SET unreachable = TRUE WHERE {column} = ANY(%s);", (unreachable_ids,))
+    cur.execute(
+        "UPDATE broadcasts SET last_target_id = %s, sent = %s, failed = %s, unreachable = %s, finished = %s WHERE id = %s;",
+        (job['cursor'], job['sent'], job['failed'], job['unreachable'], job['finished'], job['id']),
+    )
+
+async def _checkpoint_broadcast(job: dict, table: str, column: str, target_ids: list, results: list):
+    """نتیجه ارسال به target_ids (به ترتیب کلید) را در شمارنده‌ها ثبت و cursor را به آخرین آن‌ها منتقل می‌کند."""
+    unreachable_ids = [target_id for target_id, result in zip(target_ids, results) if result == 'unreachable']
+    if table == 'users':
+        # اگر دوباره /start بزنند باید مجدداً ثبت و قابل دسترس شوند
+        registered_user_ids.difference_update(unreachable_ids)
+    job['sent'] += results.count('sent')
+    job['failed'] += results.count('failed')
+    job['unreachable'] += len(unreachable_ids)
+    job['cursor'] = target_ids[-1]
+    try:
+        await db_run(_save_broadcast_page, job, table, column, unreachable_ids)
+    except Exception as e:
+        logger.error(f"Broadcast {job['id']} checkpoint failed: {e}")
+
+async def _edit_broadcast_status(bot, job: dict, finished: bool = False):
+    try:
+        await bot.edit_message_text(chat_id=job['status_chat_id'], message_id=job['status_message_id'], text=broadcast_progress_text(job, finished))
+    except BadRequest:
+        pass
+    except Exception as e:
+        logger.warning(f"Broadcast {job['id']} status edit failed: {e}")
+
+async def run_broadcast(bot, job: dict):
+    """
+    هدف‌ها را صفحه به صفحه (keyset روی کلید اصلی) از دیتابیس می‌خواند و همزمان ارسال می‌کند.
+    پس از هر صفحه checkpoint ذخیره می‌شود تا پس از ری‌استارت از همان‌جا ادامه یابد؛ اگر تسک وسط صفحه
+    لغو شود، checkpoint تا آخرین هدفی که خودش و همه هدف‌های قبلی‌اش ارسال شده‌اند ذخیره می‌شود.
+    """
+    # تسک از هندلر /fwdusers ساخته می‌شود ولی باید سقف هر چت را مثل سایر کارهای پس‌زمینه رعایت کند
+    handling_update.set(False)
+    table, column = BROADCAST_TARGETS[job['target']]
+    budget = TokenBucket(BROADCAST_PER_SECOND, max(1.0, BROADCAST_PER_SECOND))
+    slots = asyncio.Semaphore(max(1, BROADCAST_CONCURRENCY))
+    last_progress = time.monotonic()
+    try:
+        while True:
+            rows = await db_fetchall(
+                f"SELECT {column} FROM {table} WHERE {column} > %s AND NOT unreachable ORDER BY {column} LIMIT %s;",
+                (job['cursor'], BROADCAST_PAGE_SIZE),
+            )
+            if rows is None:
+                # دیتابیس در دسترس نیست؛ ارسال از آخرین checkpoint در اجرای بعدی ادامه می‌یابد
+                logger.error(f"Broadcast {job['id']} paused at {job['cursor']}: target query failed.")
+                return
+            if not rows:
+                break
+            target_ids = [row[0] for row in rows]
+            tasks = [asyncio.ensure_future(_send_broadcast_item(bot, job, target_id, budget, slots)) for target_id in target_ids]
+            try:
+                results = await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                # ارسال متوقف شد؛ فقط بخش پیوسته ابتدای صفحه که کامل ارسال شده checkpoint می‌شود
+                # تا پس از ری‌استارت نه پیامی تکراری برود و نه هدفی جا بماند
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                completed = []
+                for task in tasks:
+                    if task.cancelled() or task.exception() is not None:
+                        break
+                    completed.append(task.result())
+                if completed:
+                    await _checkpoint_broadcast(job, table, column, target_ids[:len(completed)], completed)
+                raise
+            await _checkpoint_broadcast(job, table, column, target_ids, results)
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await _edit_broadcast_status(bot, job)
+
+        job['finished'] = True
+        try:
+            await db_run(_save_broadcast_page, job, table, column, [])
+        except Exception as e:
+            logger.error(f"Broadcast {job['id']} checkpoint failed: {e}")
+        await _edit_broadcast_status(bot, job, finished=True)
+        logger.info(f"Broadcast {job['id']} to {job['target']} finished: {job['sent']} sent, {job['failed']} failed, {job['unreachable']} unreachable.")
+    finally:
+        running_broadcasts.pop(job['id'], None)
+
+def _log_broadcast_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Broadcast task {task.get_name()} crashed: {task.exception()}")
+
+def start_broadcast(application: Application, job: dict):
+    # عمداً با application.create_task ساخته نمی‌شود: Application.stop منتظر تمام آن تسک‌ها می‌ماند
+    # و توقف ربات تا پایان کل ارسال طول می‌کشید. تسک در post_stop لغو و بعداً از checkpoint ادامه داده می‌شود.
+    task = asyncio.create_task(run_broadcast(application.bot, job), name=f"broadcast-{job['id']}")
+    task.add_done_callback(_log_broadcast_failure)
+    running_broadcasts[job['id']] = task
+
+async def stop_broadcasts():
+    """ارسال‌های در حال اجرا را متوقف می‌کند؛ resume_broadcasts_job در اجرای بعدی آن‌ها را ادامه می‌دهد."""
+    tasks = list(running_broadcasts.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if tasks:
+        logger.info(f"Paused {len(tasks)} running broadcasts; they will resume from their checkpoints.")
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE):
+    """ارسال‌های همگانی نیمه‌کاره را پس از ری‌استارت از آخرین checkpoint ادامه می‌دهد."""
+    rows = await db_fetchall("SELECT id, target, from_chat_id, message_id, status_chat_id, status_message_id, last_target_id, total, sent, failed, unreachable FROM broadcasts WHERE NOT finished ORDER BY id;")
+    for row in rows or []:
+        job = dict(zip(('id', 'target', 'from_chat_id', 'message_id', 'status_chat_id', 'status_message_id', 'cursor', 'total', 'sent', 'failed', 'unreachable'), row))
+        job['finished'] = False
+        if job['id'] in running_broadcasts or job['target'] not in BROADCAST_TARGETS:
+            continue
+        logger.info(f"Resuming broadcast {job['id']} to {job['target']} after {job['cursor']}.")
+        start_broadcast(context.application, job)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE, target: str):
+    if not await is_owner(update.effective_user.id): return
+    if not update.message.reply_to_message: return await update.message.reply_text("روی یک پیام ریپلای کنید.")
+    table, column = BROADCAST_TARGETS[target]
+    count = await db_fetchone(f"SELECT COUNT(*) FROM {table} WHERE NOT unreachable;")
+    if count is None: return
+    if not count[0]: return await update.message.reply_text("هدفی یافت نشد.")
+
+    source = update.message.reply_to_message
+    status_msg = await update.message.reply_text(f"⏳ در حال ارسال به {count[0]} {target}...")
+    row = await db_fetchone(
+        "INSERT INTO broadcasts (target, from_chat_id, message_id, status_chat_id, status_message_id, last_target_id, total) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;",
+        (target, source.chat.id, source.message_id, status_msg.chat_id, status_msg.message_id, BROADCAST_START_CURSOR, count[0]),
+    )
+    if row is None: return await status_msg.edit_text("❌ ثبت ارسال همگانی در دیتابیس ناموفق بود.")
+    job = {
+        'id': row[0], 'target': target, 'from_chat_id': source.chat.id, 'message_id': source.message_id,
+        'status_chat_id': status_msg.chat_id, 'status_message_id': status_msg.message_id,
+        'cursor': BROADCAST_START_CURSOR, 'total': count[0], 'sent': 0, 'failed': 0, 'unreachable': 0, 'finished': False,
+    }
+    start_broadcast(context.application, job)
 
 async def fwdusers_command(update: Update, context: ContextTypes.DEFAULT_TYPE): await broadcast_command(update, context, "users")
 async def fwdgroups_command(update: Update, context: ContextTypes.DEFAULT_TYPE): await broadcast_command(update, context, "groups")
@@ -3819,12 +5324,8 @@ async def leave_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def grouplist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_owner(update.effective_user.id): return
-    conn = get_db_connection()
-    if conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT group_id, title, member_count FROM groups;")
-            groups = cur.fetchall()
-        conn.close()
+    groups = await db_fetchall("SELECT group_id, title, member_count FROM groups;")
+    if groups is not None:
         if not groups: return await update.message.reply_text("ربات در هیچ گروهی عضو نیست.")
         message = "📜 **لیست گروه‌ها:**\n\n"
         for i, (group_id, title, member_count) in enumerate(groups, 1):
@@ -3846,10 +5347,8 @@ async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args: return await update.message.reply_text("استفاده: /ban_user <user_id>")
     try:
         user_id = int(context.args[0])
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur: cur.execute("INSERT INTO banned_users (user_id) VALUES (%s) ON CONFLICT DO NOTHING;", (user_id,))
-            conn.commit(); conn.close()
+        if await db_execute("INSERT INTO banned_users (user_id) VALUES (%s) ON CONFLICT DO NOTHING;", (user_id,)) is not None:
+            set_user_banned(user_id, True)
             await update.message.reply_text(f"کاربر `{user_id}` با موفقیت مسدود شد.", parse_mode=ParseMode.MARKDOWN)
     except: await update.message.reply_text("آیدی نامعتبر است.")
 
@@ -3858,10 +5357,8 @@ async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not context.args: return await update.message.reply_text("استفاده: /unban_user <user_id>")
     try:
         user_id = int(context.args[0])
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur: cur.execute("DELETE FROM banned_users WHERE user_id = %s;", (user_id,))
-            conn.commit(); conn.close()
+        if await db_execute("DELETE FROM banned_users WHERE user_id = %s;", (user_id,)) is not None:
+            set_user_banned(user_id, False)
             await update.message.reply_text(f"کاربر `{user_id}` با موفقیت از مسدودیت خارج شد.", parse_mode=ParseMode.MARKDOWN)
     except: await update.message.reply_text("آیدی نامعتبر است.")
 
@@ -3872,12 +5369,8 @@ async def ban_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         group_id = int(context.args[0])
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur:
-                cur.execute("INSERT INTO banned_groups (group_id) VALUES (%s) ON CONFLICT DO NOTHING;", (group_id,))
-            conn.commit()
-            conn.close()
+        if await db_execute("INSERT INTO banned_groups (group_id) VALUES (%s) ON CONFLICT DO NOTHING;", (group_id,)) is not None:
+            set_group_banned(group_id, True)
             await update.message.reply_text(f"گروه `{group_id}` با موفقیت مسدود شد.", parse_mode=ParseMode.MARKDOWN)
             
             # Bot leaves the group after banning it
@@ -3896,113 +5389,167 @@ async def unban_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     try:
         group_id = int(context.args[0])
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM banned_groups WHERE group_id = %s;", (group_id,))
-            conn.commit()
-            conn.close()
+        if await db_execute("DELETE FROM banned_groups WHERE group_id = %s;", (group_id,)) is not None:
+            set_group_banned(group_id, False)
             await update.message.reply_text(f"گروه `{group_id}` با موفقیت از مسدودیت خارج شد.", parse_mode=ParseMode.MARKDOWN)
     except (ValueError, IndexError):
         await update.message.reply_text("لطفا یک آیدی عددی معتبر برای گروه وارد کنید.")
 
+# --- به‌روزرسانی گروه‌ها (/checkgps) ---
+CHECKGPS_CONCURRENCY = int(os.environ.get("CHECKGPS_CONCURRENCY", "5")) # حداکثر گروه‌هایی که همزمان بررسی می‌شوند
+CHECKGPS_PER_SECOND = float(os.environ.get("CHECKGPS_PER_SECOND", "10")) # سقف درخواست‌های API این دستور در ثانیه
+CHECKGPS_REPORT_PAGE_CHARS = 3500 # سقف طول هر پیام گزارش (محدودیت تلگرام ۴۰۹۶ کاراکتر است)
+
+async def _fetch_group_report(bot, group_id: int, budget: TokenBucket, slots: asyncio.Semaphore):
+    """
+    اطلاعات یک گروه را از تلگرام می‌گیرد و (title, member_count, report_text) برمی‌گرداند.
+    خطای get_chat / get_chat_member_count به فراخوان منتقل می‌شود.
+    """
+    async def limited(method, *args):
+        await budget.acquire()
+        return await method(*args)
+
+    async with slots:
+        chat_info, member_count, admins, link = await asyncio.gather(
+            limited(bot.get_chat, group_id),
+            limited(bot.get_chat_member_count, group_id),
+            limited(bot.get_chat_administrators, group_id),
+            limited(bot.export_chat_invite_link, group_id),
+            return_exceptions=True,
+        )
+    for result in (chat_info, member_count):
+        if isinstance(result, BaseException):
+            raise result
+    title = chat_info.title
+    safe_title = escape_markdown(title or "")
+
+    owner_mention = "نامشخص"
+    if isinstance(admins, BaseException):
+        owner_mention = "خطا در دریافت"
+    else:
+        for admin in admins:
+            if admin.status == 'creator':
+                owner_mention = f"[{escape_markdown(admin.user.first_name)}](tg://user?id={admin.user.id})"
+                break
+    invite_link_text = "لینک دریافت نشد" if isinstance(link, BaseException) else f"[ورود به گروه]({link})"
+
+    report_text = (
+        f"📂 **{safe_title}**\n"
+        f"🆔 `{group_id}`\n"
+        f"👥 {member_count} نفر | 👑 {owner_mention}\n"
+        f"🔗 {invite_link_text}"
+    )
+    return title, member_count, report_text
+
+def _save_checked_groups(cur, updated_rows, removed_ids):
+    """نتیجه /checkgps را در یک تراکنش ذخیره می‌کند."""
+    if updated_rows:
+        psycopg2.extras.execute_values(
+            cur,
+            "UPDATE groups AS g SET title = v.title, member_count = v.member_count FROM (VALUES %s) AS v (group_id, title, member_count) WHERE g.group_id = v.group_id;",
+            updated_rows,
+        )
+    if removed_ids:
+        cur.execute("DELETE FROM groups WHERE group_id = ANY(%s);", (removed_ids,))
+
 async def checkgps_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     اطلاعات گروه‌های ثبت‌شده در دیتابیس را به‌روزرسانی و یک گزارش کامل ارسال می‌کند.
     این دستور گروه‌های جدید را کشف نمی‌کند.
+    گروه‌ها همزمان بررسی می‌شوند و گزارش به محض آماده شدن در چند پیام ارسال می‌شود.
     """
     if not await is_owner(update.effective_user.id):
         return
 
     status_msg = await update.message.reply_text("⏳ لطفاً صبر کنید، در حال بررسی و به‌روزرسانی اطلاعات گروه‌ها...")
     
-    conn = get_db_connection()
-    if not conn:
+    group_ids = await db_fetchall("SELECT group_id FROM groups;")
+    if group_ids is None:
         await status_msg.edit_text("❌ خطا در اتصال به دیتابیس.")
         return
 
-    updated_count = 0
+    updated_rows = []
+    removed_ids = []
     error_count = 0
-    final_report = []
+    page, page_number = [], 0
+
+    async def send_report_page():
+        nonlocal page, page_number
+        page_number += 1
+        full_message = "\n\n---\n\n".join(page)
+        page = []
+        text = f"📊 **گزارش گروه‌ها (صفحه {page_number})**\n\n{full_message}"
+        try:
+            await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except BadRequest as e:
+            # اگر با وجود escape باز هم Markdown نامعتبر بود، صفحه را بدون قالب‌بندی می‌فرستیم
+            logger.warning(f"/checkgps report page {page_number} rejected as Markdown: {e}")
+            try:
+                await update.message.reply_text(text, disable_web_page_preview=True)
+            except Exception as e:
+                logger.error(f"Sending /checkgps report page {page_number} failed: {e}")
+        except Exception as e:
+            logger.error(f"Sending /checkgps report page {page_number} failed: {e}")
 
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT group_id FROM groups;")
-            group_ids = cur.fetchall()
-        
         if not group_ids:
             await status_msg.edit_text("ℹ️ هیچ گروهی در دیتابیس ثبت نشده است.")
             return
 
         await status_msg.edit_text(f"✅ تعداد {len(group_ids)} گروه در دیتابیس یافت شد. در حال به‌روزرسانی و تهیه گزارش...")
 
-        for (group_id,) in group_ids:
-            try:
-                # گرفتن اطلاعات جدید از تلگرام
-                chat_info = await context.bot.get_chat(group_id)
-                member_count = await context.bot.get_chat_member_count(group_id)
-                title = chat_info.title
-                
-                # به‌روزرسانی اطلاعات در دیتابیس
-                with conn.cursor() as cur:
-                    cur.execute("UPDATE groups SET title = %s, member_count = %s WHERE group_id = %s;", (title, member_count, group_id))
-                conn.commit()
-                updated_count += 1
-                
-                owner_mention = "نامشخص"
-                try:
-                    admins = await context.bot.get_chat_administrators(group_id)
-                    for admin in admins:
-                        if admin.status == 'creator':
-                            owner_mention = f"[{admin.user.first_name}](tg://user?id={admin.user.id})"
-                            break
-                except Exception:
-                    owner_mention = "خطا در دریافت"
-
-                invite_link_text = "لینک دریافت نشد"
-                try:
-                    link = await context.bot.export_chat_invite_link(group_id)
-                    invite_link_text = f"[ورود به گروه]({link})"
-                except Exception:
-                    pass
+        budget = TokenBucket(CHECKGPS_PER_SECOND, max(1.0, CHECKGPS_PER_SECOND))
+        slots = asyncio.Semaphore(max(1, CHECKGPS_CONCURRENCY))
 
-                report_text = (
-                    f"📂 **{title}**\n"
-                    f"🆔 `{group_id}`\n"
-                    f"👥 {member_count} نفر | 👑 {owner_mention}\n"
-                    f"🔗 {invite_link_text}"
-                )
-                final_report.append(report_text)
+        async def check_group(group_id):
+            try:
+                return group_id, await _fetch_group_report(context.bot, group_id, budget, slots), None
+            except Exception as e:
+                return group_id, None, e
 
+        page_length = 0
+        db_note = ""
+        try:
+            for future in asyncio.as_completed([check_group(group_id) for (group_id,) in group_ids]):
+                group_id, report, error = await future
+                if error is not None:
+                    error_count += 1
+                    # اگر ربات از گروه اخراج شده باشد، آن را از دیتابیس حذف می‌کنیم
+                    if "chat not found" in str(error).lower():
+                        removed_ids.append(group_id)
+                    continue
+                title, member_count, report_text = report
+
+                updated_rows.append((group_id, title, member_count))
+                if page and page_length + len(report_text) > CHECKGPS_REPORT_PAGE_CHARS:
+                    await send_report_page()
+                    page_length = 0
+                page.append(report_text)
+                page_length += len(report_text) + 7
+
+            if page:
+                await send_report_page()
+        finally:
+            # نتایج جمع‌آوری شده حتی اگر ارسال گزارش با خطا متوقف شود ذخیره می‌شوند
+            try:
+                await db_run(_save_checked_groups, updated_rows, removed_ids)
             except Exception as e:
-                error_count += 1
-                # اگر ربات از گروه اخراج شده باشد، آن را از دیتابیس حذف می‌کنیم
-                if "chat not found" in str(e).lower():
-                    with conn.cursor() as cur:
-                        cur.execute("DELETE FROM groups WHERE group_id = %s;", (group_id,))
-                    conn.commit()
-
-            await asyncio.sleep(0.5) # تأخیر برای جلوگیری از محدودیت API
-
-        # ارسال گزارش نهایی
-        if final_report:
-            full_message = "\n\n---\n\n".join(final_report)
+                logger.error(f"Saving /checkgps results failed: {e}")
+                db_note = "\n❌ ذخیره نتایج در دیتابیس ناموفق بود."
+
+        if page_number:
             await status_msg.edit_text(
-                f"📊 **گزارش نهایی گروه‌ها**\n\n"
-                f"{full_message}\n\n"
-                f"--- \n"
-                f"🔄 {updated_count} گروه به‌روزرسانی شد.\n"
+                f"📊 **گزارش نهایی گروه‌ها** ({page_number} صفحه)\n\n"
+                f"🔄 {len(updated_rows)} گروه به‌روزرسانی شد.\n"
+                f"🗑 {len(removed_ids)} گروه از دیتابیس حذف شد.{db_note}\n"
                 f"⚠️ {error_count} گروه با خطا مواجه شد (احتمالاً ربات اخراج شده).",
-                parse_mode=ParseMode.MARKDOWN,
-                disable_web_page_preview=True
+                parse_mode=ParseMode.MARKDOWN
             )
         else:
             await status_msg.edit_text("گزارشی برای نمایش وجود ندارد. ممکن است ربات از تمام گروه‌ها اخراج شده باشد.")
 
     except Exception as e:
         await status_msg.edit_text(f"🚫 بروز خطای غیرمنتظره: {e}")
-    finally:
-        conn.close()
 
 # -----------------
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -4030,22 +5577,21 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if result.new_chat_member.user.id != context.bot.id:
         return
 
+    # تغییر وضعیت خود ربات (ادمین شدن، حذف شدن و ...) لیست ادمین‌ها را هم تغییر می‌دهد
+    admin_cache.pop(chat.id)
+
     # --- وقتی ربات به گروه اضافه می‌شود ---
     if result.new_chat_member.status in ('member', 'administrator') and result.old_chat_member.status not in ('member', 'administrator'):
         logger.info(f"CONDITION MET: Bot was added to group '{chat.title}' ({chat.id})")
         
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Database connection FAILED inside track_chats.")
+        row = await db_fetchone("SELECT COUNT(*) FROM groups;")
+        if not row:
+            logger.error("Database query FAILED inside track_chats.")
             return
         
-        logger.info("Database connection successful.")
-        
         try:
             # بخش بررسی محدودیت نصب (کد اصلی شما)
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM groups;")
-                group_count = cur.fetchone()[0]
+            group_count = row[0]
 
             if group_count >= GROUP_INSTALL_LIMIT:
                 await chat.send_message(f"⚠️ ظرفیت نصب این ربات تکمیل شده است! لطفاً با پشتیبانی (@{SUPPORT_USERNAME}) تماس بگیرید.")
@@ -4056,10 +5602,8 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
             # ثبت اطلاعات در دیتابیس
             member_count = await chat.get_member_count()
-            with conn.cursor() as cur:
-                cur.execute("INSERT INTO groups (group_id, title, member_count) VALUES (%s, %s, %s) ON CONFLICT (group_id) DO UPDATE SET title = EXCLUDED.title, member_count = EXCLUDED.member_count;", (chat.id, chat.title, member_count))
-            conn.commit()
-            logger.info("SUCCESS: Group info was inserted/updated in the database.")
+            if await db_execute("INSERT INTO groups (group_id, title, member_count) VALUES (%s, %s, %s) ON CONFLICT (group_id) DO UPDATE SET title = EXCLUDED.title, member_count = EXCLUDED.member_count, unreachable = FALSE;", (chat.id, chat.title, member_count)) is not None:
+                logger.info("SUCCESS: Group info was inserted/updated in the database.")
 
             await chat.send_message("شما به همراهان راینوسول پیوستید\n\n /start برای نصب کلی ربات کافیست این دستور را ارسال کنید\n\n /rsgame سپس با تک دستور ربات پنل بازی ها را باز کنید\n\nسپاس از همراهی شما...")
 
@@ -4108,18 +5652,11 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         except Exception as e:
             logger.error(f"An unexpected error occurred in the main try block of track_chats: {e}")
-        finally:
-            conn.close()
 
     # --- وقتی ربات از گروه حذف می‌شود ---
     elif result.new_chat_member.status in ('left', 'kicked'):
         logger.info(f"CONDITION MET: Bot was removed from group '{chat.title}' ({chat.id})")
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM groups WHERE group_id = %s;", (chat.id,))
-            conn.commit()
-            conn.close()
+        await db_execute("DELETE FROM groups WHERE group_id = %s;", (chat.id,))
         
         report = f"❌ **ربات از گروه زیر اخراج شد:**\n\n🌐 نام: {chat.title}\n🆔: `{chat.id}`"
         for owner_id in OWNER_IDS:
@@ -4188,11 +5725,10 @@ async def text_help_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
 
-async def help_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def help_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: list):
     """کلیک روی دکمه‌های پنل راهنما را مدیریت می‌کند."""
     query = update.callback_query
     user = query.from_user
-    data = query.data.split('_')
     
     # --- بخش امنیتی (بدون تغییر) ---
     try:
@@ -4310,15 +5846,101 @@ async def ping_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await message.edit_text(f"راینو گیم آنلاین است!\n\n⚡️پاسخگویی: {latency_s:.4f} ثانیه")
 
 # =================================================================
+# --- مسیریابی دکمه‌های شیشه‌ای ---
+# هر کلید یک بخش از callback_data (جدا شده با '_') است؛ مقدار یا هندلر نهایی است یا جدول بخش بعدی.
+# شروع بازی‌های مکالمه‌ای (gharch_start, hads_addad_start, eteraf_start_custom, gharch_confirm_god)
+# توسط ConversationHandler ها و قبل از این مسیریاب گرفته می‌شوند.
+CALLBACK_ROUTES = {
+    'rsgame': {
+        'check': rsgame_check_join_callback,
+        'close': rsgame_close_callback,
+        'cat': rsgame_callback_handler,
+    },
+    'help': help_panel_callback,
+    'hads': {'kalame': hads_kalame_start_callback},
+    'type': {'start': type_start_callback},
+    'eteraf': {'start': {'default': eteraf_start_callback}},
+    'hokm': hokm_callback,
+    'dooz': dooz_callback,
+    'connect4': connect4_callback,
+    'rps': rps_callback,
+    'memory': memory_callback,
+    '2048': game_2048_callback,
+    'samegame': samegame_callback,
+    'spuzzle': spuzzle_callback,
+    'doz4p': doz4p_callback,
+    'gardone': gardone_callback,
+}
+
+async def route_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """callback_data را یک بار تجزیه و با جستجو در CALLBACK_ROUTES به هندلر مربوطه ارسال می‌کند."""
+    query = update.callback_query
+    if not query.data:
+        return
+    data = query.data.split('_')
+    route = CALLBACK_ROUTES
+    for part in data:
+        route = route.get(part)
+        if not isinstance(route, dict):
+            break
+    if route is None or isinstance(route, dict):
+        await query.answer()
+        return
+    await route(update, context, data)
+
+async def post_init(application: Application) -> None:
+    """کارهایی که باید یک بار پس از راه‌اندازی ربات و قبل از دریافت آپدیت‌ها انجام شوند."""
+    await reload_ban_cache()
+    logger.info(f"Ban cache loaded: {len(banned_user_ids)} users, {len(banned_group_ids)} groups.")
+    application.job_queue.run_repeating(reconcile_ban_cache_job, interval=BAN_CACHE_RECONCILE_INTERVAL, first=BAN_CACHE_RECONCILE_INTERVAL)
+    application.job_queue.run_repeating(reap_idle_games_job, interval=GAME_REAPER_INTERVAL, first=GAME_REAPER_INTERVAL)
+    if not await load_start_message():
+        application.job_queue.run_once(retry_start_message_job, START_MESSAGE_RETRY_MIN, data=START_MESSAGE_RETRY_MIN)
+    await load_typing_file_ids()
+    restored = await restore_game_states(application)
+    logger.info(f"Restored {restored} saved games.")
+    application.job_queue.run_repeating(flush_game_states_job, interval=GAME_STATE_FLUSH_INTERVAL, first=GAME_STATE_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(flush_user_registrations_job, interval=USER_REGISTRATION_FLUSH_INTERVAL, first=USER_REGISTRATION_FLUSH_INTERVAL)
+    # ارسال‌های همگانی نیمه‌کاره پس از شروع دریافت آپدیت‌ها ادامه می‌یابند
+    application.job_queue.run_once(resume_broadcasts_job, 1)
+
+async def post_stop(application: Application) -> None:
+    """قبل از توقف کامل ربات، کارهای طولانی پس‌زمینه را متوقف می‌کند."""
+    await stop_broadcasts()
+
+async def post_shutdown(application: Application) -> None:
+    """ذخیره نهایی وضعیت بازی‌ها و صف ثبت کاربران قبل از بسته شدن اتصال دیتابیس."""
+    try:
+        await flush_game_states()
+    except Exception as e:
+        logger.error(f"Final game state flush failed: {e}")
+    try:
+        await flush_user_registrations()
+    except Exception as e:
+        logger.error(f"Final user registration flush failed: {e}")
+    if spuzzle_solver_pool is not None:
+        spuzzle_solver_pool.shutdown(wait=False, cancel_futures=True)
+    render_pool.shutdown()
+
 def main() -> None:
     """Start the bot."""
+    init_db_pool()
     setup_database()
     BOT_TOKEN = os.environ.get("BOT_TOKEN")
     if not BOT_TOKEN:
         logger.critical("BOT_TOKEN environment variable not set.")
         return
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(max(1, CONCURRENT_UPDATES)))
+        .rate_limiter(TelegramRateLimiter())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # --- Conversation Handlers ---
     gharch_conv = ConversationHandler(
@@ -4372,38 +5994,11 @@ def main() -> None:
     application.add_handler(CommandHandler("ban_group", ban_group_command, filters=filters.User(OWNER_IDS)))
     application.add_handler(CommandHandler("unban_group", unban_group_command, filters=filters.User(OWNER_IDS)))
     application.add_handler(CommandHandler("checkgps", checkgps_command, filters=filters.User(OWNER_IDS)))
+    application.add_handler(CommandHandler("reloadinfo", reloadinfo_command, filters=filters.User(OWNER_IDS)))
 
-    # ========================== بخش اصلی تغییرات اینجاست ==========================
-    # --- CallbackQueryHandlers ---
-    # ترتیب بسیار مهم است: از هندلرهای اختصاصی‌تر به عمومی‌تر می‌رویم.
-
-    # ۱. هندلرهای عمومی رابط کاربری (که بخشی از یک بازی خاص نیستند)
-    application.add_handler(CallbackQueryHandler(rsgame_check_join_callback, pattern=r'^rsgame_check_join$'))
-    application.add_handler(CallbackQueryHandler(rsgame_close_callback, pattern=r'^rsgame_close_'))
-    application.add_handler(CallbackQueryHandler(rsgame_pv_callback, pattern=r'^rsgame_cat_main_pv$'))
-    
-    # ۲. تمام هندلرهای مربوط به بازی‌ها (شروع و حرکات داخلی)
-    # این‌ها باید قبل از هندلر عمومی منوها بیایند
-    application.add_handler(CallbackQueryHandler(hads_kalame_start_callback, pattern=r'^hads_kalame_start_'))
-    application.add_handler(CallbackQueryHandler(type_start_callback, pattern=r'^type_start_'))
-    application.add_handler(CallbackQueryHandler(eteraf_start_callback, pattern=r'^eteraf_start_default_'))
-    
-    application.add_handler(CallbackQueryHandler(hokm_callback, pattern=r'^hokm_'))
-    application.add_handler(CallbackQueryHandler(dooz_callback, pattern=r'^dooz_'))
-    application.add_handler(CallbackQueryHandler(connect4_callback, pattern=r'^connect4_'))
-    application.add_handler(CallbackQueryHandler(rps_callback, pattern=r'^rps_'))
-    application.add_handler(CallbackQueryHandler(memory_callback, pattern=r'^memory_'))
-    application.add_handler(CallbackQueryHandler(game_2048_callback, pattern=r'^2048_'))
-    application.add_handler(CallbackQueryHandler(samegame_callback, pattern=r'^samegame_'))
-    application.add_handler(CallbackQueryHandler(spuzzle_callback, pattern=r'^spuzzle_'))
-    application.add_handler(CallbackQueryHandler(doz4p_callback, pattern=r'^doz4p_'))
-    application.add_handler(CallbackQueryHandler(gardone_callback, pattern=r'^gardone_'))
-    # ۳. هندلر عمومی ناوبری در منوها (باید در آخر این بخش باشد)
-    application.add_handler(CallbackQueryHandler(help_panel_callback, pattern=r'^help_'))
-    # این هندلر فقط زمانی اجرا می‌شود که هیچ‌کدام از الگوهای اختصاصی‌تر بالا مطابقت نداشته باشند
-    application.add_handler(CallbackQueryHandler(rsgame_callback_handler, pattern=r'^rsgame_cat_'))
-    
-    # ========================== پایان بخش تغییرات ==========================
+    # --- CallbackQueryHandler ---
+    # همه دکمه‌ها (به جز نقاط ورود مکالمه‌ها که بالاتر ثبت شده‌اند) از یک مسیریاب جدولی عبور می‌کنند
+    application.add_handler(CallbackQueryHandler(route_callback_query))
 
     # --- Message Handlers (بدون تغییر) ---
     application.add_handler(MessageHandler(filters.Regex(r'^راهنما$'), text_help_trigger))
@@ -4414,9 +6009,12 @@ def main() -> None:
     
     # --- سایر Handler ها (بدون تغییر) ---
     application.add_handler(ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(track_admin_changes, ChatMemberHandler.CHAT_MEMBER))
     
     logger.info("Bot is starting with the new refactored logic...")
-    application.run_polling()
+    # آپدیت‌های chat_member به صورت پیش‌فرض ارسال نمی‌شوند و برای باطل کردن کش ادمین‌ها لازم‌اند
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    close_db_pool()
 
 if __name__ == "__main__":
     main()